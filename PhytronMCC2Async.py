@@ -0,0 +1,183 @@
+#!/usr/bin/python3 -u
+# coding: utf8
+# PhytronMCC2Async
+# asyncio green mode variant of PhytronMCC2Ctrl and PhytronMCC2Axis
+from tango import DevFailed, DevState, Except, GreenMode
+from tango.asyncio import DeviceProxy as AsyncDeviceProxy
+from tango.server import command, run
+import asyncio
+import time
+from PhytronMCC2Bus import NACK, get_local
+from PhytronMCC2Axis import PhytronMCC2Axis
+from PhytronMCC2Ctrl import PhytronMCC2Ctrl
+
+
+class PhytronMCC2AsyncCtrl(PhytronMCC2Ctrl):
+    """PhytronMCC2Ctrl whose bus commands await the transaction queue.
+
+    Requests of many clients are handled concurrently in the event loop,
+    the bus worker still executes them one after the other.
+    """
+    green_mode = GreenMode.Asyncio
+
+    @command(dtype_in=str, dtype_out=str)
+    async def write_read(self, cmd):
+        return (await self.transact_many_async([cmd]))[0]
+
+    @command(dtype_in=[str], dtype_out=[str], doc_in="list of commands",
+             doc_out="list of responses, NACK for each command not acknowledged")
+    async def write_read_many(self, cmds):
+        return await self.transact_many_async(cmds)
+
+    @command(dtype_in=float, dtype_out=bool, doc_in="timeout in s",
+             doc_out="True if all axes of the last group move are idle, False on timeout")
+    async def wait_group_idle(self, timeout):
+        return await self.wait_idle_async(self._group, timeout)
+
+    @command(dtype_in=float, dtype_out=bool, doc_in="timeout in s",
+             doc_out="True if the homing plan has ended, False on timeout")
+    async def wait_homing(self, timeout):
+        homing = self._homing
+        if homing is not None:
+            # the join runs in a worker thread of the event loop
+            await asyncio.get_running_loop().run_in_executor(None, homing.join, timeout)
+            return not homing.is_alive()
+        return True
+
+    async def wait_idle_async(self, axes, timeout, interval=None):
+        # as wait_idle, the event loop serves other requests between the polls
+        if interval is None:
+            interval = self.PollPeriodMoving
+        addresses = sorted(set(address for address, _ in axes))
+        t_end = time.monotonic() + timeout
+        while True:
+            answers = await self.transact_many_async([a + "SE" for a in addresses], interval)
+            moving = self._moving(axes, addresses, answers)
+            if not moving:
+                return True
+            if time.monotonic() >= t_end:
+                self.warn_stream("{:d} axes still moving after {:f} s".format(
+                    len(moving), timeout))
+                return False
+            await asyncio.sleep(interval)
+
+
+class PhytronMCC2AsyncAxis(PhytronMCC2Axis):
+    """PhytronMCC2Axis with asynchronous status, position and stop handling.
+
+    The configuration attributes and commands are inherited synchronous
+    ones. Like in the synchronous class they call a controller in the same
+    process directly, so they never wait on a CORBA call that needs this
+    event loop.
+    """
+    green_mode = GreenMode.Asyncio
+
+    async def init_device(self):
+        super().init_device()
+        self.actrl = None
+        await self._async_proxy()
+
+    async def always_executed_hook(self):
+        self._validate()
+        answer = await self._send_cmd_async("{:X}SE".format(self.Address))
+        if answer:
+            self._update_status(answer)
+
+    async def read_position(self):
+        ret = float(await self._send_cmd_async(self._bus_cmd("P20R")))
+        if self.read_inverted():
+            return -1*ret
+        else:
+            return ret
+
+    async def write_position(self, value):
+        self._check_no_scan("write_position")
+        await self._move_async(value)
+
+    @command
+    async def stop(self):
+        self._abort_wait()
+        await self._send_cmd_async(self._bus_cmd("S"))
+        self.set_state(DevState.ON)
+
+    @command
+    async def abort(self):
+        self._abort_wait()
+        await self._send_cmd_async(self._bus_cmd("SN"))
+        self.set_state(DevState.ON)
+
+    @command(dtype_in=[float], dtype_out=str,
+             doc_in="[position] or [position, timeout in s], stop and abort end the wait",
+             doc_out="JSON of the final position and the reason, see PhytronMCC2Axis")
+    async def move_and_wait(self, position_timeout):
+        if len(position_timeout) not in (1, 2):
+            Except.throw_exception("PhytronMCC2_InvalidInput",
+                                   "expected [position] or [position, timeout]", "move_and_wait")
+        timeout, abort = self._begin_wait(position_timeout[1:], "move_and_wait")
+        t_start = time.monotonic()
+        if not await self._move_async(position_timeout[0]):
+            return self._wait_result(True, await self.read_position(), t_start, rejected=True)
+        idle = await self._wait_idle_async(timeout, abort)
+        return self._wait_result(idle, await self.read_position(), t_start)
+
+    @command(dtype_in=float, dtype_out=str, doc_in="timeout in s, stop and abort end the wait",
+             doc_out="JSON of the final position and the reason, see PhytronMCC2Axis")
+    async def wait_idle(self, timeout):
+        timeout, abort = self._begin_wait([timeout], "wait_idle")
+        t_start = time.monotonic()
+        idle = await self._wait_idle_async(timeout, abort)
+        return self._wait_result(idle, await self.read_position(), t_start)
+
+    # internal methods
+    async def _move_async(self, target):
+        # starts the move, False if the module did not acknowledge it
+        value = self._prepare_move(target)
+        answer = await self._send_cmd_async(self._bus_cmd("A{:.10f}".format(value)), raw=True)
+        if answer == NACK:
+            return False
+        self.set_state(DevState.MOVING)
+        return True
+
+    async def _wait_idle_async(self, timeout, abort):
+        # the event loop serves other requests between the polls
+        t_end = time.monotonic() + timeout
+        while True:
+            answer = await self._send_cmd_async("{:X}SE".format(self.Address))
+            if answer:
+                self._update_status(answer)
+                if self.get_state() == DevState.ON:
+                    return True
+            if time.monotonic() >= t_end or abort.is_set():
+                return False
+            await asyncio.sleep(self.WaitPollInterval)
+
+    async def _async_proxy(self):
+        if self.actrl is None:
+            try:
+                self.actrl = await AsyncDeviceProxy(self.CtrlDevice)
+            except DevFailed as df:
+                self.error_stream("failed to create proxy to {:s}: {:s}".format(
+                    self.CtrlDevice, str(df.args[0].desc)))
+        return self.actrl
+
+    async def _send_cmd_async(self, cmd, raw=False):
+        ctrl_device = get_local(self.CtrlDevice)
+        if ctrl_device is not None:
+            res = (await ctrl_device.transact_many_async([cmd]))[0]
+        elif await self._async_proxy() is None:
+            res = NACK
+        else:
+            try:
+                res = await self.actrl.write_read(cmd)
+            except DevFailed:
+                res = NACK
+        if res == NACK:
+            self.set_state(DevState.FAULT)
+            self.warn_stream("command not acknowledged from controller "
+                             "-> Fault State")
+            return res if raw else ""
+        return res
+
+
+if __name__ == "__main__":
+    run([PhytronMCC2AsyncCtrl, PhytronMCC2AsyncAxis], green_mode=GreenMode.Asyncio)
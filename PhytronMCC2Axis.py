@@ -1,11 +1,77 @@
 #!/usr/bin/python3 -u
 # coding: utf8
 # PhytronMCC2Axis
-from tango import Database, DevFailed, AttrWriteType, DevState, DeviceProxy, DispLevel
+from tango import Database, DevFailed, AttrWriteType, DevState, DeviceProxy, DispLevel, Except
+from tango import AutoTangoAllowThreads, Util
 from tango.server import device_property
 from tango.server import Device, attribute, command
-import sys
+import json
+import re
+import threading
+import time
 from enum import IntEnum
+import numpy as np
+from PhytronMCC2Bus import NACK, decode_status, get_local, parse_value, format_value
+
+
+# resources shared by all axes of this server: one proxy per ctrl. device,
+# one database connection, the memorized attributes of all devices read in
+# one query and the firmware version per module
+_shared_lock = threading.Lock()
+_shared_proxies = {}
+_shared_database = None
+_memorized = None
+_memorized_used = set()
+_firmware = {}
+
+
+def _shared_proxy(name):
+    key = name.lower()
+    with _shared_lock:
+        if key not in _shared_proxies:
+            _shared_proxies[key] = DeviceProxy(name)
+        return _shared_proxies[key]
+
+
+def _shared_db():
+    global _shared_database
+    with _shared_lock:
+        if _shared_database is None:
+            _shared_database = Database()
+        return _shared_database
+
+
+def _load_memorized(db):
+    # {device: {attribute: value}} of all devices of this server, the tables
+    # are those of the MySQL backend of the Tango database
+    query = ("SELECT d.name, p.attribute, p.value FROM property_attribute_device p, device d "
+             "WHERE p.device = d.name AND p.name = '__value' "
+             "AND d.server = '{:s}'".format(Util.instance().get_ds_name()))
+    _, values = db.command_inout("DbMySqlSelect", query)
+    memorized = {}
+    for device, attr, value in zip(values[0::3], values[1::3], values[2::3]):
+        memorized.setdefault(device.lower(), {})[attr.lower()] = value
+    return memorized
+
+
+def _memorized_value(db, device, attr):
+    # the bulk query only serves the first init of each device, a later Init
+    # may follow a write of the attribute
+    global _memorized
+    device = device.lower()
+    with _shared_lock:
+        if _memorized is None:
+            try:
+                _memorized = _load_memorized(db)
+            except Exception:
+                # fall back to one query per device
+                _memorized = False
+        bulk = _memorized is not False and device not in _memorized_used
+        _memorized_used.add(device)
+        if bulk:
+            return _memorized.get(device, {}).get(attr)
+    value = db.get_device_attribute_property(device, [attr])[attr].get("__value")
+    return value[0] if value else None
 
 
 class MovementType(IntEnum):
@@ -43,6 +109,48 @@ class PhytronMCC2Axis(Device):
         dtype="str"
     )
 
+    ScanPollInterval = device_property(
+        dtype="float",
+        default_value=0.01,
+        doc="status poll interval in s while waiting for a scan point",
+    )
+
+    ScanMoveTimeout = device_property(
+        dtype="float",
+        default_value=300.0,
+        doc="max. time in s to reach a scan point",
+    )
+
+    WaitPollInterval = device_property(
+        dtype="float",
+        default_value=0.01,
+        doc="status poll interval in s of move_and_wait and wait_idle",
+    )
+
+    PositionTolerance = device_property(
+        dtype="float",
+        default_value=0.001,
+        doc="max. distance from the target in units of the position that counts as reached",
+    )
+
+    LazyInit = device_property(
+        dtype="bool",
+        default_value=False,
+        doc="defer the check of the module (IVR) to the first request",
+    )
+
+    HistoryRate = device_property(
+        dtype="float",
+        default_value=100.0,
+        doc="default sample rate in Hz of the position history",
+    )
+
+    HistoryDepth = device_property(
+        dtype="int",
+        default_value=10000,
+        doc="default number of samples in the position history",
+    )
+
     # device attributes
     hw_limit_minus = attribute(
         dtype="bool",
@@ -213,18 +321,135 @@ Limit direction +"""
         doc="Allowed unit values are step, mm, inch, degree"
     )
 
+    parameter_cache_hit_rate = attribute(
+        dtype="float",
+        format="%5.1f",
+        label="parameter cache hit rate",
+        unit="%",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="share of parameter reads served without a bus transaction",
+    )
+
+    scan_dwell_times = attribute(
+        dtype=("float",),
+        max_dim_x=100000,
+        label="scan dwell times",
+        unit="s",
+        access=AttrWriteType.READ_WRITE,
+        display_level=DispLevel.OPERATOR,
+        doc="dwell time per scan point, a single value applies to all points",
+    )
+
+    scan_positions = attribute(
+        dtype=("float",),
+        max_dim_x=100000,
+        label="scan positions",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.OPERATOR,
+        doc="positions reached at the scan points so far",
+    )
+
+    scan_point = attribute(
+        dtype="int",
+        label="scan point",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.OPERATOR,
+        doc="index of the last reached scan point, -1 before the first, "
+            "pushes a change event per point",
+    )
+
+    scan_progress = attribute(
+        dtype="float",
+        format="%5.1f",
+        label="scan progress",
+        unit="%",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.OPERATOR,
+    )
+
+    history_rate = attribute(
+        dtype="float",
+        format="%8.2f",
+        label="history rate",
+        unit="Hz",
+        access=AttrWriteType.READ_WRITE,
+        display_level=DispLevel.EXPERT,
+        doc="sample rate of the position history, limited by the bus",
+    )
+
+    history_depth = attribute(
+        dtype="int",
+        label="history depth",
+        access=AttrWriteType.READ_WRITE,
+        display_level=DispLevel.EXPERT,
+        doc="number of samples in the position history, a write clears it",
+    )
+
+    history_times = attribute(
+        dtype=("float",),
+        max_dim_x=1000000,
+        label="history times",
+        unit="s",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="timestamps (UNIX time) of the history samples, oldest first",
+    )
+
+    position_history = attribute(
+        dtype=("float",),
+        max_dim_x=1000000,
+        label="position history",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="position (P20) per history sample",
+    )
+
+    encoder_history = attribute(
+        dtype=("float",),
+        max_dim_x=1000000,
+        label="encoder history",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="encoder position (P22 times P39) per history sample, NaN without encoder",
+    )
+
+    following_error = attribute(
+        dtype=("float",),
+        max_dim_x=1000000,
+        label="following error",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="position minus encoder position per history sample",
+    )
+
+    init_time = attribute(
+        dtype="float",
+        format="%8.1f",
+        label="init time",
+        unit="ms",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="duration of the last init_device",
+    )
+
     # private class properties
-    __NACK = chr(0x15)     # command failed
-    __LIM_PLUS = 2
-    __LIM_MINUS = 1
+    __NACK = NACK
     __Axis_Name = ''
     __HW_Limit_Minus = False
     __HW_Limit_Plus = False
     __Inverted = False
+    __Validated = False
     __Unit = MovementUnit.step
     __Steps_Per_Unit = 1.0
+    # slow-changing parameters, they only change when written
+    __CACHED_PARAMS = (1, 2, 3, 8, 14, 15, 23, 24, 40, 41, 45)
+    __CONFIG_PARAMS = range(1, 50)
+    # electronical, mechanical, absolute and encoder counter are no configuration
+    __COUNTER_PARAMS = (19, 20, 21, 22)
 
     def init_device(self):
+        t_init = time.monotonic()
         super().init_device()
         self.info_stream("init_device()")
 
@@ -237,59 +462,82 @@ Limit direction +"""
         self.info_stream("module axis: {:d}".format(self.Axis))
         self.info_stream("alias: {:s}".format(self.Alias))
 
+        self.__Param_Cache = {}
+        self.__Cache_Hits = 0
+        self.__Cache_Misses = 0
+
+        self.__Scan_Thread = None
+        self.__Scan_Abort = threading.Event()
+        self.__Wait_Abort = threading.Event()
+        self.__Target = None
+        self.__Scan_Dwell_Times = [0.0]
+        self.__Scan_Positions = []
+        self.__Scan_Point = -1
+        self.__Scan_Length = 0
+        self.__Scan_Error = ""
+
+        # ring buffer of timestamp, position and encoder position per sample
+        self.__History_Thread = None
+        self.__History_Stop = threading.Event()
+        self.__History_Lock = threading.Lock()
+        self.__History_Rate = self.HistoryRate
+        self._alloc_history(self.HistoryDepth)
+
+        # the device stays in FAULT until the ctrl. device can be reached
+        self.ctrl = None
+        self._proxy()
+        self._open_ctrl()
+
+        # read memorized attributes from Database
         try:
-            self.ctrl = DeviceProxy(self.CtrlDevice)
-            self.info_stream("ctrl. device: {:s}".format(self.CtrlDevice))
-        except DevFailed as df:
-            self.error_stream("failed to create proxy to {:s}".format(df))
-            sys.exit(255)
+            self.db = _shared_db()
+            self.__Inverted = _memorized_value(self.db, self.get_name(), "inverted") == "true"
+        except Exception:
+            self.db = None
+            self.__Inverted = False
 
-        # check if the CrlDevice ON, if not open the serial port
-        if str(self.ctrl.state()) == "OFF":
-            self.ctrl.open()
-            self.info_stream("controller sucessfully opened")
-        else:
-            self.info_stream("controller was already open")
-
-        if ("MCC" in self.read_firmware_version()):
-            # read memorized attributes from Database
-            self.db = Database()
-            try:
-                attr = self.db.get_device_attribute_property(self.get_name(), ["inverted"])
-                if attr["inverted"]["__value"][0] == "true":
-                    self.__Inverted = True
-                else:
-                    self.__Inverted = False
-            except Exception:
-                self.__Inverted = False
-            self.set_state(DevState.ON)
-        else:
-            self.set_state(DevState.OFF)
+        self.__Validated = False
+        if not self.LazyInit:
+            self._validate()
 
         self.info_stream("HW limit-: {0}".format(self.__HW_Limit_Minus))
         self.info_stream("HW limit+: {0}".format(self.__HW_Limit_Plus))
 
+        # change and archive events are pushed when the values change
+        self.__Pushed = {}
+        for attr in ["State", "position", "hw_limit_minus", "hw_limit_plus",
+                     "scan_point", "scan_positions"]:
+            self.set_change_event(attr, True, False)
+            self.set_archive_event(attr, True, False)
+        self._register_axis()
+
+        self.__Init_Time = time.monotonic() - t_init
+        self.info_stream("init_device() done in {:.1f} ms".format(1000*self.__Init_Time))
+
     def delete_device(self):
+        self.__Wait_Abort.set()
+        self._abort_scan()
+        self._stop_history()
+        ctrl_device = get_local(self.CtrlDevice)
+        if ctrl_device is not None:
+            ctrl_device.remove_listener(self.Address, self.Axis)
         self.set_state(DevState.OFF)
 
     def always_executed_hook(self):
+        self._validate()
         answer = self._send_cmd("SE")
-        if (self.Axis == 0):
-            if self.__Inverted:
-                self.__HW_Limit_Minus = bool(int(answer[2]) & self.__LIM_PLUS)
-                self.__HW_Limit_Plus = bool(int(answer[2]) & self.__LIM_MINUS)
-            else:
-                self.__HW_Limit_Minus = bool(int(answer[2]) & self.__LIM_MINUS)
-                self.__HW_Limit_Plus = bool(int(answer[2]) & self.__LIM_PLUS)
-            moving = not(bool(int(answer[1]) & 1))
-        else:
-            if self.__Inverted:
-                self.__HW_Limit_Minus = bool(int(answer[6]) & self.__LIM_PLUS)
-                self.__HW_Limit_Plus = bool(int(answer[6]) & self.__LIM_MINUS)
-            else:
-                self.__HW_Limit_Minus = bool(int(answer[6]) & self.__LIM_MINUS)
-                self.__HW_Limit_Plus = bool(int(answer[6]) & self.__LIM_PLUS)
-            moving = not(bool(int(answer[5]) & 1))
+        if answer:
+            self._update_status(answer)
+        if self.__Scan_Thread is not None:
+            self.set_status("Scan running at point {:d} of {:d}".format(
+                self.__Scan_Point + 1, self.__Scan_Length))
+        elif self.__Scan_Error:
+            self.set_status("{:s}\nLast scan failed at {:s}".format(
+                self.get_status(), self.__Scan_Error))
+
+    def _update_status(self, answer):
+        moving, self.__HW_Limit_Minus, self.__HW_Limit_Plus = decode_status(
+            answer, self.Axis, self.__Inverted)
         self.debug_stream("HW limit-: {0}".format(self.__HW_Limit_Minus))
         self.debug_stream("HW limit+: {0}".format(self.__HW_Limit_Plus))
         if moving is False:
@@ -300,6 +548,30 @@ Limit direction +"""
             self.set_status("Device is MOVING")
             self.set_state(DevState.MOVING)
             self.debug_stream("device is: MOVING")
+        self._push_event("State", self.get_state())
+        self._push_event("hw_limit_minus", self.__HW_Limit_Minus)
+        self._push_event("hw_limit_plus", self.__HW_Limit_Plus)
+
+    def _poll_update(self, status, position):
+        # called from the poller thread of the controller
+        if status == self.__NACK or position == self.__NACK:
+            return
+        self._update_status(status)
+        position = float(position)
+        if self.__Inverted:
+            position = -1*position
+        self._push_event("position", position)
+
+    def _push_event(self, attr, value):
+        if self.__Pushed.get(attr) == value:
+            return
+        self.__Pushed[attr] = value
+        if attr == "State":
+            self.push_change_event(attr)
+            self.push_archive_event(attr)
+        else:
+            self.push_change_event(attr, value)
+            self.push_archive_event(attr, value)
 
     # attribute read/write methods
     def read_hw_limit_minus(self):
@@ -309,7 +581,7 @@ Limit direction +"""
         return self.__HW_Limit_Plus
 
     def read_sw_limit_minus(self):
-        ret = float(self.send_cmd("P24R"))
+        ret = float(self._read_param(24))
         if self.__Inverted:
             return -1*ret
         else:
@@ -318,10 +590,11 @@ Limit direction +"""
     def write_sw_limit_minus(self, value):
         if self.__Inverted:
             value = -1*value
-        self.send_cmd("P24S{:f}".format(value))
+        self._write_param(24, "{:f}".format(value))
+        self._register_axis()
 
     def read_sw_limit_plus(self):
-        ret = float(self.send_cmd("P23R"))
+        ret = float(self._read_param(23))
         if self.__Inverted:
             return -1*ret
         else:
@@ -330,21 +603,15 @@ Limit direction +"""
     def write_sw_limit_plus(self, value):
         if self.__Inverted:
             value = -1*value
-        self.send_cmd("P23S{:f}".format(value))
+        self._write_param(23, "{:f}".format(value))
+        self._register_axis()
 
     def read_position(self):
-        ret = float(self.send_cmd("P20R"))
-        if self.__Inverted:
-            return -1*ret
-        else:
-            return ret
+        return self._read_position()
 
     def write_position(self, value):
-        if self.__Inverted:
-            value = -1*value
-        answer = self.send_cmd("A{:.10f}".format(value))
-        if answer != self.__NACK:
-            self.set_state(DevState.MOVING)
+        self._check_no_scan("write_position")
+        self._move(value)
 
     def read_alias(self):
         return self.Alias
@@ -354,70 +621,76 @@ Limit direction +"""
 
     def write_inverted(self, value):
         self.__Inverted = bool(value)
+        # the controller needs the sign for group moves
+        self._register_axis()
 
     def read_acceleration(self):
-        return int(self.send_cmd("P15R"))
+        return int(self._read_param(15))
 
     def write_acceleration(self, value):
-        self.send_cmd("P15S{:d}".format(value))
+        self._write_param(15, "{:d}".format(value))
 
     def read_velocity(self):
-        return int(self.send_cmd("P14R"))
+        return int(self._read_param(14))
 
     def write_velocity(self, value):
-        self.send_cmd("P14S{:d}".format(value))
+        self._write_param(14, "{:d}".format(value))
 
     def read_homing_velocity(self):
-        return int(self.send_cmd("P08R"))
+        return int(self._read_param(8))
 
     def write_homing_velocity(self, value):
-        self.send_cmd("P08S{:d}".format(value))
+        self._write_param(8, "{:d}".format(value))
 
     def read_run_current(self):
-        return float(self.send_cmd("P41R"))/10
+        return float(self._read_param(41))/10
 
     def write_run_current(self, value):
         value = int(value*10)
         if value not in range(0, 26):
-            return "input not in range 0..25"
-        self.send_cmd("P41S{:d}".format(value))
+            Except.throw_exception("PhytronMCC2_InvalidInput", "input not in range 0..2.5",
+                                   "write_run_current")
+        self._write_param(41, "{:d}".format(value))
 
     def read_hold_current(self):
-        return float(self.send_cmd("P40R"))/10
+        return float(self._read_param(40))/10
 
     def write_hold_current(self, value):
         value = int(value*10)
         if value not in range(0, 26):
-            return "input not in range 0..25"
-        self.send_cmd("P40S{:d}".format(value))
+            Except.throw_exception("PhytronMCC2_InvalidInput", "input not in range 0..2.5",
+                                   "write_hold_current")
+        self._write_param(40, "{:d}".format(value))
 
     def read_initiator_type(self):
-        return InitiatorType.NOC if bool(int(self.send_cmd("P27R"))) else InitiatorType.NCC
+        return InitiatorType.NOC if bool(int(self._axis_cmd("P27R"))) else InitiatorType.NCC
 
     def write_initiator_type(self, value):
-        self.send_cmd("P27S{:d}".format(int(value)))
+        self._axis_cmd("P27S{:d}".format(int(value)))
 
     def read_steps_per_unit(self):
         # inverse of spindle pitch (see manual page 50)
-        self.__Steps_Per_Unit = 1/float(self.send_cmd("P03R"))
+        self.__Steps_Per_Unit = 1/float(self._read_param(3))
         return self.__Steps_Per_Unit
 
     def write_steps_per_unit(self, value):
         # inverse of spindle pitch (see manual page 50)
-        self.send_cmd("P03S{:10.8f}".format(1/value))
+        self._write_param(3, "{:10.8f}".format(1/value))
         # update display unit
         self.set_display_unit()
 
     def read_step_resolution(self):
-        return int(self.send_cmd("P45R"))
+        return int(self._read_param(45))
 
     def write_step_resolution(self, value):
         if value not in [1, 2, 4, 8, 10, 16, 128, 256]:
-            return "input not in [1, 2, 4, 8, 10, 16, 128, 256]"
-        self.send_cmd("P45S{:d}".format(value))
+            Except.throw_exception("PhytronMCC2_InvalidInput",
+                                   "input not in [1, 2, 4, 8, 10, 16, 128, 256]",
+                                   "write_step_resolution")
+        self._write_param(45, "{:d}".format(value))
 
     def read_backlash_compensation(self):
-        ret = int(self.send_cmd("P25R"))
+        ret = int(self._axis_cmd("P25R"))
         if self.__Inverted:
             return -1*ret
         else:
@@ -426,16 +699,16 @@ Limit direction +"""
     def write_backlash_compensation(self, value):
         if self.__Inverted:
             value = -1*value
-        self.send_cmd("P25S{:d}".format(int(value)))
+        self._axis_cmd("P25S{:d}".format(int(value)))
 
     def read_type_of_movement(self):
-        return MovementType.linear if bool(int(self.send_cmd("P01R"))) else MovementType.rotational
+        return MovementType.linear if bool(int(self._read_param(1))) else MovementType.rotational
 
     def write_type_of_movement(self, value):
-        self.send_cmd("P01S{:d}".format(int(value)))
+        self._write_param(1, "{:d}".format(int(value)))
 
     def read_movement_unit(self):
-        res = int(self.send_cmd("P02R"))
+        res = int(self._read_param(2))
         if res == 1:
             self.__Unit = MovementUnit.step
         elif res == 2:
@@ -447,10 +720,67 @@ Limit direction +"""
         return self.__Unit
 
     def write_movement_unit(self, value):
-        self.send_cmd("P02S{:d}".format(int(value+1)))
+        self._write_param(2, "{:d}".format(int(value+1)))
         self.read_movement_unit()
         self.set_display_unit()
 
+    def read_scan_dwell_times(self):
+        return self.__Scan_Dwell_Times
+
+    def write_scan_dwell_times(self, value):
+        self.__Scan_Dwell_Times = [float(dwell) for dwell in value]
+
+    def read_scan_positions(self):
+        return self.__Scan_Positions
+
+    def read_scan_point(self):
+        return self.__Scan_Point
+
+    def read_scan_progress(self):
+        if self.__Scan_Length == 0:
+            return 0.0
+        return 100.0*(self.__Scan_Point + 1)/self.__Scan_Length
+
+    def read_history_rate(self):
+        return self.__History_Rate
+
+    def write_history_rate(self, value):
+        if value <= 0:
+            Except.throw_exception("PhytronMCC2_InvalidInput", "rate must be positive",
+                                   "write_history_rate")
+        self.__History_Rate = value
+
+    def read_history_depth(self):
+        return self.__History.shape[1]
+
+    def write_history_depth(self, value):
+        if not 0 < value <= 1000000:
+            Except.throw_exception("PhytronMCC2_InvalidInput", "depth must be 1..1000000",
+                                   "write_history_depth")
+        self._alloc_history(value)
+
+    def read_history_times(self):
+        return self._history()[0]
+
+    def read_position_history(self):
+        return self._history()[1]
+
+    def read_encoder_history(self):
+        return self._history()[2]
+
+    def read_following_error(self):
+        history = self._history()
+        return history[1] - history[2]
+
+    def read_init_time(self):
+        return 1000*self.__Init_Time
+
+    def read_parameter_cache_hit_rate(self):
+        reads = self.__Cache_Hits + self.__Cache_Misses
+        if reads == 0:
+            return 0.0
+        return 100.0*self.__Cache_Hits/reads
+
     # internal methods
     def set_display_unit(self):
         attributes = [b"position", b"sw_limit_minus", b"sw_limit_plus"]
@@ -463,76 +793,530 @@ Limit direction +"""
                 ac3[0].format = b"%8.3f"
             self.set_attribute_config_3(ac3)
 
-    def _send_cmd(self, cmd):
-        # add module address to beginning of command
-        cmd = str(self.Address) + cmd
-        res = self.ctrl.write_read(cmd)
+    def _read_param(self, nr):
+        if nr in self.__CACHED_PARAMS:
+            value = self.__Param_Cache.get(nr)
+            if value is not None:
+                self.__Cache_Hits += 1
+                return value
+            self.__Cache_Misses += 1
+        value = self._axis_cmd("P{:02d}R".format(nr))
+        if value and nr in self.__CACHED_PARAMS:
+            self.__Param_Cache[nr] = value
+        return value
+
+    def _read_limits(self):
+        # P24, P23 from the cache, the missing ones in one transaction
+        missing = [nr for nr in (24, 23) if nr not in self.__Param_Cache]
+        if missing:
+            answers = self._write_read_many([self._bus_cmd("P{:02d}R".format(nr))
+                                             for nr in missing])
+            for nr, answer in zip(missing, answers):
+                if answer != self.__NACK:
+                    self.__Param_Cache[nr] = answer
+        return [self.__Param_Cache.get(nr, "") for nr in (24, 23)]
+
+    def _write_param(self, nr, value):
+        self.__Param_Cache.pop(nr, None)
+        res = self._send_cmd("{:s}P{:02d}S{:s}".format(self.__Axis_Name, nr, value), raw=True)
+        if res != self.__NACK and nr in self.__CACHED_PARAMS:
+            self.__Param_Cache[nr] = value.strip()
+
+    def _read_status(self, max_age=None):
+        # the module status, max_age bounds the age of a cached answer
+        cmd = "{:X}SE".format(self.Address)
+        ctrl_device = get_local(self.CtrlDevice)
+        if ctrl_device is not None:
+            answer = self.__NACK if ctrl_device.bus is None else ctrl_device.transact(cmd, max_age)
+        else:
+            answer = self._write_read(cmd)
+        return "" if answer == self.__NACK else answer
+
+    def _wait_idle(self, timeout, interval, abort=None):
+        # returns False on timeout or abort, by default the abort of the scan
+        if abort is None:
+            abort = self.__Scan_Abort
+        t_end = time.monotonic() + timeout
+        while True:
+            answer = self._read_status(max_age=interval)
+            if answer:
+                self._update_status(answer)
+                if self.get_state() == DevState.ON:
+                    return True
+            if time.monotonic() >= t_end or abort.wait(interval):
+                return False
+
+    def _wait_idle_unlocked(self, timeout, abort):
+        # releases the device monitor while waiting, so stop, abort and State
+        # are served and end the wait
+        with AutoTangoAllowThreads(self):
+            return self._wait_idle(timeout, self.WaitPollInterval, abort)
+
+    def _prepare_move(self, target):
+        # validates and remembers the target, returns it with the sign of the hardware
+        self._validate_target(target)
+        self.__Target = target
+        return -1*target if self.__Inverted else target
+
+    def _read_position(self):
+        # synchronous also in the asyncio variant, the scan thread calls it
+        ret = float(self._axis_cmd("P20R"))
+        if self.__Inverted:
+            return -1*ret
+        else:
+            return ret
+
+    def _move(self, target):
+        # starts the move, False if the module did not acknowledge it
+        value = self._prepare_move(target)
+        answer = self._send_cmd("{:s}A{:.10f}".format(self.__Axis_Name, value), raw=True)
+        if answer == self.__NACK:
+            return False
+        self.set_state(DevState.MOVING)
+        return True
+
+    def _check_no_scan(self, origin):
+        # the scan thread owns the axis until it ends
+        if self.__Scan_Thread is not None:
+            Except.throw_exception("PhytronMCC2_ScanRunning", "a scan is running", origin)
+
+    def _begin_wait(self, args, origin):
+        # timeout from [timeout] or [position, timeout], the event aborts the wait
+        self._check_no_scan(origin)
+        self.__Wait_Abort.clear()
+        return (args[-1] if args else self.ScanMoveTimeout), self.__Wait_Abort
+
+    def _abort_wait(self):
+        self.__Scan_Abort.set()
+        self.__Wait_Abort.set()
+
+    def _wait_result(self, idle, position, t_start, rejected=False):
+        # JSON of the final position and why the motion ended
+        target = self.__Target
+        if rejected:
+            reason = "rejected"
+        elif self.__Wait_Abort.is_set():
+            reason = "stopped"
+        elif not idle:
+            reason = "timeout"
+        elif target is not None and abs(position - target) <= self.PositionTolerance:
+            reason = "target reached"
+        elif self.__HW_Limit_Minus or self.__HW_Limit_Plus:
+            reason = "limit hit"
+        elif target is None:
+            reason = "idle"
+        else:
+            reason = "stopped"
+        self.info_stream("wait ended: {:s} at {:f}".format(reason, position))
+        return json.dumps({"position": position, "reason": reason,
+                           "elapsed": time.monotonic() - t_start})
+
+    def _scan(self, targets, dwell_times):
+        self.info_stream("scan of {:d} points started".format(len(targets)))
+        i = 0
+        try:
+            for i, target in enumerate(targets):
+                if not self._move(target):
+                    self.__Scan_Error = "point {:d}: move not acknowledged".format(i)
+                    self.error_stream("scan failed at {:s}".format(self.__Scan_Error))
+                    break
+                if not self._wait_idle(self.ScanMoveTimeout, self.ScanPollInterval):
+                    self.warn_stream("scan stopped before point {:d}".format(i))
+                    break
+                position = self._read_position()
+                if abs(position - target) > self.PositionTolerance:
+                    # limit switch, stop by another client or lost steps
+                    self.__Scan_Error = "point {:d}: stopped at {:f} instead of {:f}".format(
+                        i, position, target)
+                    self.error_stream("scan failed at {:s}".format(self.__Scan_Error))
+                    break
+                self.__Scan_Positions.append(position)
+                self.__Scan_Point = i
+                self.push_change_event("scan_positions", self.__Scan_Positions)
+                self.push_change_event("scan_point", i)
+                if self.__Scan_Abort.wait(dwell_times[i]):
+                    break
+            else:
+                self.info_stream("scan finished")
+        except Exception as ex:
+            # also DevFailed of the event pushes, the scan must not stay "running"
+            self.__Scan_Error = "point {:d}: {}".format(i, ex)
+            self.error_stream("scan failed at {:s}".format(self.__Scan_Error))
+        finally:
+            self.__Scan_Thread = None
+
+    def _abort_scan(self):
+        scan_thread = self.__Scan_Thread
+        if scan_thread is not None:
+            self.__Scan_Abort.set()
+            scan_thread.join()
+
+    def _soft_limits(self):
+        # (minus, plus) in the units of the position attribute from the
+        # cached P24/P23, -inf/inf where the limit is 0 (off) or unknown
+        limits = []
+        for nr, off in ((24, -np.inf), (23, np.inf)):
+            value = parse_value(self._read_param(nr))
+            limits.append(off if not value else float(value))
+        if self.__Inverted:
+            return -limits[1], -limits[0]
+        return limits[0], limits[1]
+
+    def _check_targets(self, targets):
+        # True per target inside the soft limits, without a bus transaction
+        # once the limits are cached
+        limit_minus, limit_plus = self._soft_limits()
+        targets = np.asarray(targets, dtype=float)
+        return (targets >= limit_minus) & (targets <= limit_plus)
+
+    def _validate_target(self, target, origin="write_position"):
+        if not self._check_targets([target])[0]:
+            limit_minus, limit_plus = self._soft_limits()
+            Except.throw_exception("PhytronMCC2_OutOfRange",
+                                   "target {:f} outside the soft limits [{:f}, {:f}]".format(
+                                       target, limit_minus, limit_plus), origin)
+
+    def _alloc_history(self, depth):
+        with self.__History_Lock:
+            self.__History = np.full((3, depth), np.nan)
+            self.__History_Index = 0
+            self.__History_Count = 0
+
+    def _history(self):
+        # ordered copy of the ring buffer, oldest sample first
+        with self.__History_Lock:
+            if self.__History_Count < self.__History.shape[1]:
+                return self.__History[:, :self.__History_Count].copy()
+            i = self.__History_Index
+            return np.concatenate((self.__History[:, i:], self.__History[:, :i]), axis=1)
+
+    def _sample_history(self, encoder_factor):
+        # one bus transaction per sample, encoder_factor is None without encoder
+        cmds = [self._bus_cmd("P20R")]
+        if encoder_factor is not None:
+            cmds.append(self._bus_cmd("P22R"))
+        sign = -1.0 if self.__Inverted else 1.0
+        t_next = time.monotonic()
+        while not self.__History_Stop.wait(max(0.0, t_next - time.monotonic())):
+            answers = self._write_read_many(cmds)
+            t = time.time()
+            with self.__History_Lock:
+                i = self.__History_Index
+                self.__History[0, i] = t
+                self.__History[1, i] = sign*self._history_value(answers[0])
+                if encoder_factor is not None:
+                    self.__History[2, i] = sign*encoder_factor*self._history_value(answers[1])
+                self.__History_Index = (i + 1) % self.__History.shape[1]
+                self.__History_Count = min(self.__History_Count + 1, self.__History.shape[1])
+            # samples that are late are skipped, not sent in a burst
+            t_next = max(t_next + 1.0/self.__History_Rate, time.monotonic())
+
+    def _history_value(self, answer):
+        try:
+            return float(answer)
+        except ValueError:
+            return np.nan
+
+    def _stop_history(self):
+        history_thread = self.__History_Thread
+        if history_thread is not None:
+            self.__History_Stop.set()
+            history_thread.join()
+            self.__History_Thread = None
+
+    def _register_axis(self):
+        # the controller checks group moves against the sign and the soft
+        # limits as on the module, a lazy axis sends them once it is validated
+        registration = [self.Address, self.Axis, int(self.__Inverted)]
+        if self.__Validated or not self.LazyInit:
+            limits = self._read_limits()
+            if all(limits):
+                registration += [float(parse_value(limit)) for limit in limits]
+        # the background poller of a controller in this process feeds the events
+        ctrl_device = get_local(self.CtrlDevice)
+        if ctrl_device is not None:
+            ctrl_device.add_listener(self.Address, self.Axis, self._poll_update)
+            ctrl_device.register_axis(registration)
+        elif self._proxy() is not None:
+            try:
+                self.ctrl.register_axis(registration)
+            except DevFailed as df:
+                self.warn_stream("could not register axis: {:s}".format(str(df.args[0].desc)))
+
+    def _validate(self):
+        # the module has to identify itself once, else the axis stays OFF
+        if self.__Validated:
+            return True
+        if "MCC" in self._firmware_version():
+            self.__Validated = True
+            self.set_state(DevState.ON)
+            if self.LazyInit:
+                self._register_axis()
+        else:
+            self.set_state(DevState.OFF)
+        return self.__Validated
+
+    def _firmware_version(self):
+        # all axes of a module share the firmware version
+        version = _firmware.get((self.CtrlDevice.lower(), self.Address))
+        if version is None:
+            version = self.read_firmware_version()
+        return version
+
+    def _proxy(self):
+        # (re)create the proxy to the ctrl. device, None if not reachable
+        if self.ctrl is None:
+            try:
+                self.ctrl = _shared_proxy(self.CtrlDevice)
+                self.info_stream("ctrl. device: {:s}".format(self.CtrlDevice))
+            except DevFailed as df:
+                self.error_stream("failed to create proxy to {:s}: {:s}".format(
+                    self.CtrlDevice, str(df.args[0].desc)))
+                self.set_state(DevState.FAULT)
+                self.set_status("ctrl. device {:s} not reachable".format(self.CtrlDevice))
+        return self.ctrl
+
+    def _open_ctrl(self):
+        # check if the CrlDevice ON, if not open the serial port
+        ctrl_device = get_local(self.CtrlDevice)
+        try:
+            if ctrl_device is not None:
+                self.info_stream("ctrl. device runs in this server")
+                state = ctrl_device.get_state()
+            elif self._proxy() is not None:
+                state = self.ctrl.state()
+            else:
+                return
+            if state == DevState.OFF:
+                if ctrl_device is not None:
+                    ctrl_device.open()
+                else:
+                    self.ctrl.open()
+                self.info_stream("controller sucessfully opened")
+            else:
+                self.info_stream("controller was already open")
+        except DevFailed as df:
+            self.warn_stream("could not open ctrl. device: {:s}".format(str(df.args[0].desc)))
+
+    def _axis_cmd(self, cmd):
+        # add axis name (X, Y) to beginning of command
+        return self._send_cmd(str(self.__Axis_Name) + cmd)
+
+    def _bus_cmd(self, cmd):
+        # the complete bus command with module address and axis name
+        return "{:X}{:s}{:s}".format(self.Address, self.__Axis_Name, cmd)
+
+    def _write_read(self, cmd):
+        # a controller in this server is called directly instead of by CORBA
+        ctrl_device = get_local(self.CtrlDevice)
+        if ctrl_device is not None:
+            if ctrl_device.bus is None:
+                # the controller could not open its port
+                return self.__NACK
+            return ctrl_device.transact(cmd)
+        return self._write_read_many([cmd])[0]
+
+    def _write_read_many(self, cmds):
+        ctrl_device = get_local(self.CtrlDevice)
+        if ctrl_device is not None:
+            if ctrl_device.bus is None:
+                return [self.__NACK]*len(cmds)
+            return ctrl_device.transact_many(cmds)
+        # a ctrl. device that is down or reconnecting answers NACK
+        if self._proxy() is None:
+            return [self.__NACK]*len(cmds)
+        try:
+            if len(cmds) == 1:
+                return [self.ctrl.write_read(cmds[0])]
+            return list(self.ctrl.write_read_many(cmds))
+        except DevFailed as df:
+            self.debug_stream("ctrl. device failed: {:s}".format(str(df.args[0].desc)))
+            return [self.__NACK]*len(cmds)
+
+    def _send_cmd(self, cmd, raw=False):
+        # add module address (hex digit 0..F) to beginning of command
+        cmd = "{:X}".format(self.Address) + cmd
+        res = self._write_read(cmd)
         if res == self.__NACK:
             self.set_state(DevState.FAULT)
             self.warn_stream("command not acknowledged from controller "
                              "-> Fault State")
-            return ""
+            return res if raw else ""
         return res
 
     # commands
     @command(dtype_in=str, dtype_out=str, doc_in="enter a command", doc_out="the response")
     def send_cmd(self, cmd):
-        # add axis name (X, Y) to beginning of command
-        return self._send_cmd(str(self.__Axis_Name) + cmd)
+        # a raw parameter write bypasses the parameter cache
+        match = re.match(r"P(\d+)S", cmd)
+        if match:
+            self.__Param_Cache.pop(int(match.group(1)), None)
+        answer = self._axis_cmd(cmd)
+        if match and int(match.group(1)) in (23, 24):
+            self._register_axis()
+        return answer
+
+    @command
+    def refresh_parameters(self):
+        # re-read all cached parameters in one bus transaction
+        params = sorted(self.__CACHED_PARAMS)
+        answers = self._write_read_many([self._bus_cmd("P{:02d}R".format(nr)) for nr in params])
+        self.__Param_Cache = {}
+        for nr, answer in zip(params, answers):
+            if answer != self.__NACK:
+                self.__Param_Cache[nr] = answer
+        self._register_axis()
+        self.info_stream("parameter cache refreshed")
 
     @command(dtype_out=str, doc_out="the firmware version")
     def read_firmware_version(self):
         version = self._send_cmd("IVR")
+        if "MCC" in version:
+            _firmware[(self.CtrlDevice.lower(), self.Address)] = version
         return version
 
     @command(dtype_in=float, doc_in="position")
     def set_position(self, value):
+        self._check_no_scan("set_position")
         if self.__Inverted:
             value = -1*value
-        self.send_cmd("P20S{:.4f}".format(value))
+        self._axis_cmd("P20S{:.4f}".format(value))
 
     @command
     def jog_plus(self):
+        self._check_no_scan("jog_plus")
+        self.__Target = None
         if self.__Inverted:
-            self.send_cmd("L-")
+            self._axis_cmd("L-")
         else:
-            self.send_cmd("L+")
+            self._axis_cmd("L+")
         self.set_state(DevState.MOVING)
 
     @command
     def jog_minus(self):
+        self._check_no_scan("jog_minus")
+        self.__Target = None
         if self.__Inverted:
-            self.send_cmd("L+")
+            self._axis_cmd("L+")
         else:
-            self.send_cmd("L-")
+            self._axis_cmd("L-")
         self.set_state(DevState.MOVING)
 
     @command
     def homing_plus(self):
+        self._check_no_scan("homing_plus")
+        self.__Target = None
         if self.__Inverted:
-            self.send_cmd("0-")
+            self._axis_cmd("0-")
         else:
-            self.send_cmd("0+")
+            self._axis_cmd("0+")
         self.set_state(DevState.MOVING)
 
     @command
     def homing_minus(self):
+        self._check_no_scan("homing_minus")
+        self.__Target = None
         if self.__Inverted:
-            self.send_cmd("0+")
+            self._axis_cmd("0+")
         else:
-            self.send_cmd("0-")
+            self._axis_cmd("0-")
         self.set_state(DevState.MOVING)
 
     @command
     def stop(self):
-        self.send_cmd("S")
+        self._abort_wait()
+        self._axis_cmd("S")
         self.set_state(DevState.ON)
 
     @command
     def abort(self):
-        self.send_cmd("SN")
+        self._abort_wait()
+        self._axis_cmd("SN")
         self.set_state(DevState.ON)
 
+    @command(dtype_in=[float], dtype_out=str,
+             doc_in="[position] or [position, timeout in s], the client timeout of the "
+                    "proxy must be longer than the wait",
+             doc_out="JSON {\"position\": ..., \"reason\": \"target reached\", "
+                     "\"limit hit\", \"stopped\", \"rejected\" or \"timeout\", "
+                     "\"elapsed\": s}")
+    def move_and_wait(self, position_timeout):
+        if len(position_timeout) not in (1, 2):
+            Except.throw_exception("PhytronMCC2_InvalidInput",
+                                   "expected [position] or [position, timeout]", "move_and_wait")
+        timeout, abort = self._begin_wait(position_timeout[1:], "move_and_wait")
+        t_start = time.monotonic()
+        if not self._move(position_timeout[0]):
+            return self._wait_result(True, self._read_position(), t_start, rejected=True)
+        idle = self._wait_idle_unlocked(timeout, abort)
+        return self._wait_result(idle, self._read_position(), t_start)
+
+    @command(dtype_in=float, dtype_out=str,
+             doc_in="timeout in s, the client timeout of the proxy must be longer",
+             doc_out="JSON {\"position\": ..., \"reason\": ..., \"elapsed\": s} as "
+                     "move_and_wait, \"idle\" if no target is known")
+    def wait_idle(self, timeout):
+        timeout, abort = self._begin_wait([timeout], "wait_idle")
+        t_start = time.monotonic()
+        idle = self._wait_idle_unlocked(timeout, abort)
+        return self._wait_result(idle, self._read_position(), t_start)
+
+    @command(dtype_in=[float], dtype_out=[bool], doc_in="target positions",
+             doc_out="True per target inside the soft limits (sw_limit_minus, sw_limit_plus)")
+    def check_positions(self, targets):
+        return self._check_targets(targets)
+
+    @command(dtype_in=[float], doc_in="target positions, see also scan_dwell_times")
+    def scan(self, targets):
+        if self.__Scan_Thread is not None:
+            Except.throw_exception("PhytronMCC2_ScanRunning", "a scan is already running", "scan")
+        targets = [float(target) for target in targets]
+        outside = np.flatnonzero(~self._check_targets(targets))
+        if len(outside):
+            Except.throw_exception("PhytronMCC2_OutOfRange",
+                                   "{:d} targets outside the soft limits, the first is point "
+                                   "{:d}".format(len(outside), outside[0]), "scan")
+        dwell_times = self.__Scan_Dwell_Times
+        if len(dwell_times) == 1:
+            dwell_times = dwell_times*len(targets)
+        elif len(dwell_times) != len(targets):
+            Except.throw_exception("PhytronMCC2_InvalidInput",
+                                   "scan_dwell_times needs 1 or {:d} values".format(len(targets)),
+                                   "scan")
+        self.__Scan_Abort.clear()
+        self.__Scan_Positions = []
+        self.__Scan_Point = -1
+        self.__Scan_Length = len(targets)
+        self.__Scan_Error = ""
+        self.__Scan_Thread = threading.Thread(target=self._scan, args=(targets, dwell_times),
+                                              name="MCC2Scan", daemon=True)
+        self.__Scan_Thread.start()
+
+    @command
+    def abort_scan(self):
+        self._abort_scan()
+        self._axis_cmd("S")
+
+    @command
+    def start_history(self):
+        # clears the history and samples until stop_history
+        self._stop_history()
+        self._alloc_history(self.__History.shape[1])
+        encoder_factor = None
+        if parse_value(self._read_param(34)):
+            encoder_factor = parse_value(self._read_param(39)) or 1.0
+        self.__History_Stop.clear()
+        self.__History_Thread = threading.Thread(target=self._sample_history,
+                                                 args=(encoder_factor,),
+                                                 name="MCC2History", daemon=True)
+        self.__History_Thread.start()
+        self.info_stream("history sampling at {:.1f} Hz started".format(self.__History_Rate))
+
+    @command
+    def stop_history(self):
+        self._stop_history()
+        self.info_stream("history sampling stopped")
+
     @command(dtype_in=str)
     def set_alias(self, name):
         self.Alias = name
@@ -546,12 +1330,55 @@ Limit direction +"""
 
     @command(dtype_out=str)
     def dump_config(self):
-        parameters = range(1, 50)
-        res = ""
-        for par in parameters:
-            cmd = "P{:02d}R".format(par)
-            res = res + "P{:02d}: {:s}\n".format(par, str(self.send_cmd(cmd)))
-        return res
+        config = self._read_config()
+        return "".join("P{:02d}: {:s}\n".format(par, value) for par, value in config.items())
+
+    @command(dtype_out=str, doc_out="JSON object of all parameter values {\"P01\": value, ...}")
+    def dump_config_json(self):
+        config = self._read_config()
+        return json.dumps({"P{:02d}".format(par): parse_value(value)
+                           for par, value in config.items()})
+
+    @command(dtype_in=str, dtype_out=str,
+             doc_in="JSON object of parameter values {\"P01\": value, ...}",
+             doc_out="JSON object of the written, unchanged and failed parameters")
+    def load_config(self, config):
+        config = {int(par.lstrip("Pp")): value for par, value in json.loads(config).items()
+                  if value is not None}
+        for par in self.__COUNTER_PARAMS:
+            config.pop(par, None)
+        current = self._read_config(sorted(config))
+        changed = [par for par, value in config.items()
+                   if parse_value(current.get(par, "")) != value]
+        answers = self._write_read_many([self._bus_cmd("P{:02d}S{:s}".format(
+            par, format_value(config[par]))) for par in changed])
+        result = {"written": {}, "unchanged": [], "failed": []}
+        for par, answer in zip(changed, answers):
+            self.__Param_Cache.pop(par, None)
+            if answer == self.__NACK:
+                result["failed"].append("P{:02d}".format(par))
+            else:
+                result["written"]["P{:02d}".format(par)] = config[par]
+        result["unchanged"] = ["P{:02d}".format(par) for par in sorted(config)
+                               if par not in changed]
+        if 23 in changed or 24 in changed:
+            self._register_axis()
+        self.info_stream("load_config: {:d} parameters written".format(len(result["written"])))
+        return json.dumps(result)
+
+    def _read_config(self, params=None):
+        # read all parameters in one bus transaction
+        if params is None:
+            params = self.__CONFIG_PARAMS
+        answers = self._write_read_many([self._bus_cmd("P{:02d}R".format(par)) for par in params])
+        config = {}
+        for par, answer in zip(params, answers):
+            if answer == self.__NACK:
+                answer = ""
+            elif par in self.__CACHED_PARAMS:
+                self.__Param_Cache[par] = answer
+            config[par] = answer
+        return config
 
 
 if __name__ == "__main__":
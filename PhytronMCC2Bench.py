@@ -0,0 +1,291 @@
+#!/usr/bin/python3 -u
+# coding: utf8
+# PhytronMCC2Bench
+# benchmarks of the serial hot path against the simulated bus, no hardware needed
+#
+#     ./PhytronMCC2Bench.py protocol --output bench.json
+#     ./PhytronMCC2Bench.py greenmode --axes 8 --clients 16
+#     ./PhytronMCC2Bench.py multibus --buses 4 --latency 0.002
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from PhytronMCC2Bus import MCC2Bus, STX, ACK, ETX, decode_status, parse_value
+from PhytronMCC2Sim import MCC2Simulator, SimulatedSerial, PtySimulator
+
+
+class ReplayPort():
+    """Serial port that answers every frame with the same reply instantly."""
+
+    def __init__(self, reply):
+        self.reply = (STX + ACK + reply + ETX).encode("utf-8")
+        self.timeout = None
+
+    def reset_input_buffer(self):
+        pass
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read_until(self, expected=b"\n", size=None):
+        return self.reply
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction*(len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(name, func, n, warmup=100):
+    for _ in range(warmup):
+        func()
+    # latency distribution
+    latencies = []
+    t_total = time.perf_counter()
+    for _ in range(n):
+        t0 = time.perf_counter_ns()
+        func()
+        latencies.append(time.perf_counter_ns() - t0)
+    t_total = time.perf_counter() - t_total
+    latencies.sort()
+    # allocations in a separate pass, tracing slows down the calls
+    samples = min(n, 1000)
+    tracemalloc.start()
+    peak = 0
+    for _ in range(samples):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        func()
+        peak += tracemalloc.get_traced_memory()[1] - start
+    tracemalloc.stop()
+    result = {
+        "name": name,
+        "n": n,
+        "ops_per_s": n/t_total,
+        "p50_us": percentile(latencies, 0.50)/1000,
+        "p99_us": percentile(latencies, 0.99)/1000,
+        "alloc_bytes_per_op": peak/samples,
+    }
+    print("{:<32s} {:>12.0f} ops/s  p50 {:>9.2f} us  p99 {:>9.2f} us  {:>8.0f} B/op".format(
+        name, result["ops_per_s"], result["p50_us"], result["p99_us"],
+        result["alloc_bytes_per_op"]))
+    return result
+
+
+def bench_protocol(args):
+    results = []
+
+    # frame building and reply parsing of a transaction without any I/O wait
+    bus = MCC2Bus(ReplayPort("12.5000"), 0.1)
+    results.append(measure("write_read framing", lambda: bus._write_read("0XP20R"), args.n))
+
+    # the same through the simulated modules
+    simulator = MCC2Simulator([0, 1], latency=0.0)
+    bus = MCC2Bus(SimulatedSerial(simulator, timeout=0.1), 0.1)
+    results.append(measure("write_read simulated", lambda: bus._write_read("0XP20R"), args.n))
+
+    # a full transaction through the queue and the worker thread
+    simulator.latency = args.latency
+    bus.start()
+    results.append(measure("transaction queued", lambda: bus.transact("0SE"), args.n))
+    results.append(measure("transaction batch of 10",
+                           lambda: bus.transact_many(["0XP{:02d}R".format(nr)
+                                                      for nr in range(10, 20)]),
+                           max(1, args.n//10)))
+    bus.stop()
+
+    # status decoding as in always_executed_hook
+    results.append(measure("decode_status", lambda: decode_status("01200100", 1, True), args.n))
+
+    # numeric reply parsing as in the read_* methods
+    results.append(measure("parse float reply", lambda: float("12.5000"), args.n))
+    results.append(measure("parse_value int", lambda: parse_value("4000"), args.n))
+    results.append(measure("parse_value float", lambda: parse_value("12.5000"), args.n))
+    return results
+
+
+def run_clients(proxies, attr, clients, duration):
+    # each client reads the attribute of all axes in turn
+    counts = [0]*clients
+    latencies = [[] for _ in range(clients)]
+    t_end = time.monotonic() + duration
+
+    def client(index):
+        i = index
+        while time.monotonic() < t_end:
+            t0 = time.perf_counter_ns()
+            proxies[i % len(proxies)].read_attribute(attr)
+            latencies[index].append(time.perf_counter_ns() - t0)
+            counts[index] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    merged = sorted(lat for lats in latencies for lat in lats)
+    return sum(counts)/duration, merged
+
+
+def bench_greenmode(args):
+    # the device servers run against the simulated bus on a pseudo terminal
+    from tango import DeviceProxy
+    from tango.test_context import MultiDeviceTestContext
+    from PhytronMCC2Axis import PhytronMCC2Axis
+    from PhytronMCC2Ctrl import PhytronMCC2Ctrl
+    from PhytronMCC2Async import PhytronMCC2AsyncAxis, PhytronMCC2AsyncCtrl
+
+    results = []
+    variants = [
+        ("synchronous", PhytronMCC2Ctrl, PhytronMCC2Axis),
+        ("asyncio", PhytronMCC2AsyncCtrl, PhytronMCC2AsyncAxis),
+    ]
+    modules = (args.axes + 1)//2
+    for name, ctrl_class, axis_class in variants:
+        simulator = MCC2Simulator(range(modules), latency=args.latency)
+        server = PtySimulator(simulator)
+        server.start()
+        devices_info = [
+            {"class": ctrl_class,
+             "devices": [{"name": "bench/mcc2/ctrl",
+                          "properties": {"Port": server.port, "StatusMaxAge": 0.0}}]},
+            {"class": axis_class,
+             "devices": [{"name": "bench/mcc2/axis{:d}".format(i),
+                          "properties": {"CtrlDevice": "bench/mcc2/ctrl",
+                                         "Address": i//2, "Axis": i % 2,
+                                         "Alias": "axis{:d}".format(i)}}
+                         for i in range(args.axes)]},
+        ]
+        with MultiDeviceTestContext(devices_info, process=True) as context:
+            proxies = [DeviceProxy(context.get_device_access("bench/mcc2/axis{:d}".format(i)))
+                       for i in range(args.axes)]
+            run_clients(proxies, "position", args.clients, 1.0)
+            reads_per_s, latencies = run_clients(proxies, "position", args.clients,
+                                                 args.duration)
+        server.stop()
+        result = {
+            "name": "{:s} position reads".format(name),
+            "axes": args.axes,
+            "clients": args.clients,
+            "ops_per_s": reads_per_s,
+            "p50_us": percentile(latencies, 0.50)/1000,
+            "p99_us": percentile(latencies, 0.99)/1000,
+        }
+        print("{:<32s} {:>12.0f} ops/s  p50 {:>9.2f} us  p99 {:>9.2f} us".format(
+            result["name"], result["ops_per_s"], result["p50_us"], result["p99_us"]))
+        results.append(result)
+    print("asyncio/synchronous throughput: {:.2f}".format(
+        results[1]["ops_per_s"]/results[0]["ops_per_s"]))
+    return results
+
+
+def bench_multibus(args):
+    # one PhytronMCC2Ctrl per bus in one device server, each on its own
+    # simulated port (pseudo terminal) whose modules answer after the latency
+    from tango import DeviceProxy
+    from tango.test_context import MultiDeviceTestContext
+    from PhytronMCC2Ctrl import PhytronMCC2Ctrl
+
+    latency = args.latency or 0.001
+    results = []
+    for buses in range(1, args.buses + 1):
+        servers = [PtySimulator(MCC2Simulator([0, 1], latency=latency)) for _ in range(buses)]
+        for server in servers:
+            server.start()
+        devices_info = [
+            {"class": PhytronMCC2Ctrl,
+             "devices": [{"name": "bench/mcc2/ctrl{:d}".format(i),
+                          "properties": {"Port": server.port}}
+                         for i, server in enumerate(servers)]},
+        ]
+        with MultiDeviceTestContext(devices_info, process=True) as context:
+            proxies = [DeviceProxy(context.get_device_access("bench/mcc2/ctrl{:d}".format(i)))
+                       for i in range(buses)]
+            counts = [0]*buses
+            t_end = time.monotonic() + args.duration
+
+            def client(index):
+                # one transaction in flight per bus, no coalescing
+                while time.monotonic() < t_end:
+                    proxies[index].write_read("{:X}XP20R".format(counts[index] % 2))
+                    counts[index] += 1
+
+            threads = [threading.Thread(target=client, args=(i,)) for i in range(buses)]
+            t0 = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - t0
+        for server in servers:
+            server.stop()
+        result = {
+            "name": "{:d} buses".format(buses),
+            "buses": buses,
+            "latency": latency,
+            "ops_per_s": sum(counts)/elapsed,
+        }
+        result["scaling"] = result["ops_per_s"]/(buses*results[0]["ops_per_s"]) \
+            if results else 1.0
+        print("{:<32s} {:>12.0f} ops/s  scaling efficiency {:>6.1%}".format(
+            result["name"], result["ops_per_s"], result["scaling"]))
+        results.append(result)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks of the PhytronMCC2 device servers")
+    parser.add_argument("suite", choices=["protocol", "greenmode", "multibus"],
+                        help="benchmark suite to run")
+    parser.add_argument("--n", type=int, default=10000, help="iterations per benchmark")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="reply latency of the simulated modules in s (multibus: 0.001 if 0)")
+    parser.add_argument("--axes", type=int, default=8, help="number of axis devices (greenmode)")
+    parser.add_argument("--clients", type=int, default=16,
+                        help="number of concurrent clients (greenmode)")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="duration of each measurement in s (greenmode, multibus)")
+    parser.add_argument("--buses", type=int, default=4,
+                        help="max. number of buses (multibus)")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    suites = {
+        "protocol": bench_protocol,
+        "greenmode": bench_greenmode,
+        "multibus": bench_multibus,
+    }
+    results = suites[args.suite](args)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({
+                "suite": args.suite,
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "arguments": vars(args),
+                "results": results,
+            }, f, indent=2)
+        print("results written to {:s}".format(args.output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
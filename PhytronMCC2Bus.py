@@ -0,0 +1,632 @@
+# coding: utf8
+# PhytronMCC2Bus
+# transaction layer for the half-duplex RS485 bus of the MCC2 modules
+import heapq
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from serial import SerialException
+try:
+    from termios import error as TermiosError
+except ImportError:
+    # no termios on Windows
+    TermiosError = OSError
+
+# definition some constants
+STX = chr(2)         # Start of text
+ACK = chr(6)         # Command ok
+NACK = chr(0x15)     # command failed
+ETX = chr(3)         # end of text
+
+AXIS_NAMES = ("X", "Y")
+
+# limit switch bits in the extended status (SE)
+LIM_MINUS = 1
+LIM_PLUS = 2
+
+# command classes of the statistics
+STAT_CLASSES = ("status", "param_read", "param_write", "motion", "other")
+# upper bounds of the latency histogram bins in ms, the last bin is open
+LATENCY_BINS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# default number of repetitions after a NACK or timeout per command class,
+# only commands that are safe to repeat: reads, parameter writes, absolute
+# moves, homing and stop; relative moves and other commands are sent once
+RETRY_DEFAULTS = {
+    "status": 2,
+    "param_read": 2,
+    "param_write": 1,
+    "motion": 1,
+    "stop": 3,
+    "other": 0,
+}
+
+# errors of a port that is gone, pyserial calls tcflush/tcdrain directly and
+# passes termios.error, which is no OSError
+PORT_ERRORS = (OSError, SerialException, TermiosError)
+
+# transaction priorities, lower values are served first
+PRIO_STOP = 0
+PRIO_MOTION = 1
+PRIO_DEFAULT = 2
+PRIO_POLL = 3
+
+
+def format_address(address):
+    return "{:X}".format(int(address))
+
+
+def split_command(cmd):
+    # a bus command starts with the module address 0..F
+    return cmd[:1], cmd[1:]
+
+
+def command_class(cmd):
+    _, module_cmd = split_command(cmd)
+    if module_cmd[:1] in ("X", "Y"):
+        axis_cmd = module_cmd[1:]
+        if axis_cmd in ("S", "SN"):
+            return "stop"
+        if axis_cmd.startswith("P"):
+            return "param_read" if axis_cmd.endswith("R") else "param_write"
+        if axis_cmd[:1] in ("A", "L", "0"):
+            return "motion"
+    elif module_cmd == "SE":
+        return "status"
+    return "other"
+
+
+def stat_class(cmd):
+    cls = command_class(cmd)
+    return "motion" if cls == "stop" else cls
+
+
+def is_read_only(cmd):
+    # commands without side effects, concurrent identical ones can share a reply
+    return command_class(cmd) in ("status", "param_read") or split_command(cmd)[1] == "IVR"
+
+
+def parse_retry_policy(entries):
+    # ["class=count", ...] overriding RETRY_DEFAULTS, raises ValueError
+    policy = dict(RETRY_DEFAULTS)
+    for entry in entries:
+        cls, _, count = entry.partition("=")
+        cls = cls.strip()
+        if cls not in policy:
+            raise ValueError("unknown command class {:s}".format(cls))
+        policy[cls] = max(0, int(count))
+    return policy
+
+
+def command_priority(cmd):
+    cls = command_class(cmd)
+    if cls == "stop":
+        return PRIO_STOP
+    elif cls == "motion":
+        return PRIO_MOTION
+    elif cls in ("status", "param_read"):
+        return PRIO_POLL
+    return PRIO_DEFAULT
+
+
+def invalidates_status(cmd):
+    # commands that change the motion state of an axis
+    return command_class(cmd) in ("motion", "stop")
+
+
+def decode_status(answer, axis, inverted=False):
+    # the extended status has four digits per axis, X first, then Y
+    offset = 4*axis
+    moving = not bool(int(answer[offset + 1]) & 1)
+    limits = int(answer[offset + 2])
+    limit_minus = bool(limits & LIM_MINUS)
+    limit_plus = bool(limits & LIM_PLUS)
+    if inverted:
+        limit_minus, limit_plus = limit_plus, limit_minus
+    return moving, limit_minus, limit_plus
+
+
+def parse_value(answer):
+    # numeric value of a parameter reply, int where possible, None if invalid
+    try:
+        return int(answer)
+    except ValueError:
+        pass
+    try:
+        return float(answer)
+    except ValueError:
+        return None
+
+
+def format_value(value):
+    if float(value).is_integer():
+        return "{:d}".format(int(value))
+    return "{:.8f}".format(value)
+
+
+# controller devices running in this process, by device name
+_local_controllers = {}
+
+
+def _normalize_device_name(name):
+    name = name.lower().split("#")[0]
+    if name.startswith("tango://"):
+        name = name.split("/", 3)[-1]
+    return name
+
+
+def register_local(name, device):
+    _local_controllers[_normalize_device_name(name)] = device
+
+
+def unregister_local(name):
+    _local_controllers.pop(_normalize_device_name(name), None)
+
+
+def get_local(name):
+    return _local_controllers.get(_normalize_device_name(name))
+
+
+def _ignore(msg):
+    pass
+
+
+# buses by serial port, each with its own worker, shared by all controller
+# devices of this process on that port
+_buses = {}
+_bus_users = {}
+_bus_settings = {}
+_buses_lock = threading.Lock()
+
+
+def acquire_bus(port, factory, state_callback=None, streams=None, settings=None):
+    # the bus of port, created with factory() for its first user and started;
+    # later users must ask for the same settings, else ValueError
+    settings = dict(settings or {})
+    with _buses_lock:
+        bus = _buses.get(port)
+        if bus is None:
+            bus = _buses[port] = factory()
+            _bus_users[port] = 0
+            _bus_settings[port] = settings
+        differing = sorted(key for key in set(settings) | set(_bus_settings[port])
+                           if settings.get(key) != _bus_settings[port].get(key))
+        if differing:
+            raise ValueError("{:s} is already in use with other {:s}".format(
+                port, ", ".join(differing)))
+        _bus_users[port] += 1
+        if state_callback is not None:
+            bus.state_callbacks.append(state_callback)
+        if streams is not None:
+            bus.log_streams.append(streams)
+    bus.start()
+    if state_callback is not None:
+        state_callback(bus.connected)
+    return bus
+
+
+def release_bus(port, state_callback=None, streams=None):
+    # the last user stops the worker and closes the port
+    with _buses_lock:
+        bus = _buses.get(port)
+        if bus is None:
+            return
+        if state_callback in bus.state_callbacks:
+            bus.state_callbacks.remove(state_callback)
+        if streams in bus.log_streams:
+            bus.log_streams.remove(streams)
+        _bus_users[port] -= 1
+        if _bus_users[port] > 0:
+            return
+        del _buses[port]
+        del _bus_users[port]
+        del _bus_settings[port]
+    bus.stop()
+
+
+class BusStatistics():
+    """Counters and latency histograms per command class."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {cls: 0 for cls in STAT_CLASSES}
+            self.nacks = {cls: 0 for cls in STAT_CLASSES}
+            self.timeouts = {cls: 0 for cls in STAT_CLASSES}
+            self.latency_sum = {cls: 0.0 for cls in STAT_CLASSES}
+            self.histogram = {cls: [0]*(len(LATENCY_BINS) + 1) for cls in STAT_CLASSES}
+            self.busy = 0.0
+            self.coalesced = 0
+            self.retries = {cls: 0 for cls in STAT_CLASSES}
+            self.retries_exhausted = {cls: 0 for cls in STAT_CLASSES}
+            self.t_reset = time.monotonic()
+
+    def record(self, cls, latency, nack=False, timeout=False):
+        latency_ms = latency*1000
+        index = len(LATENCY_BINS)
+        for i, bound in enumerate(LATENCY_BINS):
+            if latency_ms <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[cls] += 1
+            self.latency_sum[cls] += latency
+            self.histogram[cls][index] += 1
+            self.busy += latency
+            if timeout:
+                self.timeouts[cls] += 1
+            elif nack:
+                self.nacks[cls] += 1
+
+    def record_retry(self, cls, exhausted=False):
+        with self._lock:
+            if exhausted:
+                self.retries_exhausted[cls] += 1
+            else:
+                self.retries[cls] += 1
+
+    def record_coalesced(self):
+        with self._lock:
+            self.coalesced += 1
+
+    def mean_latency(self, cls):
+        with self._lock:
+            if self.counts[cls] == 0:
+                return 0.0
+            return self.latency_sum[cls]/self.counts[cls]
+
+    def utilisation(self):
+        # fraction of the wall time the port was busy with transactions
+        with self._lock:
+            elapsed = time.monotonic() - self.t_reset
+            return self.busy/elapsed if elapsed > 0 else 0.0
+
+
+class MCC2Bus():
+    """Serializes all transactions on one serial port in a worker thread.
+
+    Callers from any thread submit commands, the worker executes them one
+    after the other ordered by priority, so stop commands overtake queued
+    status and parameter polling, and run between the commands of a batch
+    that is already on the bus.
+
+    The worker also owns the port: on I/O errors it closes it, answers all
+    requests with NACK and reopens it with a bounded exponential backoff.
+    The state callbacks, state_callback(connected), are called on every
+    change of the connection.
+
+    The status cache and the log streams belong to the bus, so all devices
+    sharing the port see the same status answers, and the messages go to
+    the longest-standing of the (debug_stream, warn_stream) in log_streams.
+    """
+
+    def __init__(self, serial, timeout, debug_stream=_ignore, warn_stream=_ignore,
+                 state_callback=None, min_backoff=0.1, max_backoff=5.0, retries=None,
+                 status_max_age=0.0):
+        self.serial = serial
+        self.timeout = timeout
+        # repetitions after a NACK or timeout per command class
+        self.retries = dict(RETRY_DEFAULTS if retries is None else retries)
+        self.status_cache = StatusCache(status_max_age)
+        self.log_streams = []
+        self._default_streams = (debug_stream, warn_stream)
+        self.state_callbacks = [] if state_callback is None else [state_callback]
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # module addresses that are revalidated after a reconnect
+        self.addresses = set()
+        self.connected = False
+        self.reconnect_count = 0
+        self.response_time = 0.0
+        self.wait_time = 0.0
+        self.statistics = BusStatistics()
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._worker = None
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._backoff = min_backoff
+        self._t_retry = 0.0
+        self._t_down = None
+        self._downtime = 0.0
+
+    def debug_stream(self, msg):
+        self._streams()[0](msg)
+
+    def warn_stream(self, msg):
+        self._streams()[1](msg)
+
+    def _streams(self):
+        # users come and go in other threads, the slice is taken at once
+        return (self.log_streams[:1] or [self._default_streams])[0]
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def downtime(self):
+        # total time in s without connection, including a running outage
+        if self._t_down is None:
+            return self._downtime
+        return self._downtime + time.monotonic() - self._t_down
+
+    def start(self):
+        if self._worker is not None:
+            return
+        try:
+            if not self.serial.is_open:
+                self.serial.open()
+            self._set_connected(True)
+        except PORT_ERRORS + (ValueError,) as ex:
+            self._lost_connection(ex)
+        self._worker = threading.Thread(target=self._run, name="MCC2Bus", daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        if self._worker is None:
+            return
+        # the sentinel sorts before every transaction
+        self._queue.put((-1, next(self._seq), [], None, 0.0, None, False))
+        self._worker.join()
+        self._worker = None
+        self.serial.close()
+        self.connected = False
+
+    def submit(self, cmds, priority=None):
+        # identical read-only requests in flight share one transaction
+        if len(cmds) == 1 and is_read_only(cmds[0]):
+            cmd = cmds[0]
+            with self._inflight_lock:
+                fut = self._inflight.get(cmd)
+                if fut is not None:
+                    self.statistics.record_coalesced()
+                    return fut
+                fut = self._submit(cmds, priority)
+                self._inflight[cmd] = fut
+            fut.add_done_callback(lambda done: self._remove_inflight(cmd, done))
+            return fut
+        return self._submit(cmds, priority)
+
+    def _remove_inflight(self, cmd, fut):
+        with self._inflight_lock:
+            if self._inflight.get(cmd) is fut:
+                del self._inflight[cmd]
+
+    def _submit(self, cmds, priority=None, timeout=None, probing=False):
+        # the commands of one transaction are executed back-to-back, timeout
+        # replaces the reply deadline of the bus for this transaction; a
+        # probing transaction expects missing replies and is not retried
+        fut = Future()
+        if not cmds:
+            fut.set_result([])
+            return fut
+        if self._worker is None or not self.connected:
+            # fail fast while the port is down
+            fut.set_result([NACK]*len(cmds))
+            return fut
+        if priority is None:
+            priority = min(command_priority(cmd) for cmd in cmds)
+        self._queue.put((priority, next(self._seq), cmds, fut, time.monotonic(), timeout,
+                         probing))
+        return fut
+
+    def transact(self, cmd, priority=None):
+        return self.submit([cmd], priority).result()[0]
+
+    def transact_many(self, cmds, priority=None):
+        return self.submit(cmds, priority).result()
+
+    def probe(self, addresses, timeout):
+        # firmware version (IVR) per module address, NACK where none answers
+        cmds = [format_address(address) + "IVR" for address in addresses]
+        return self._submit(cmds, PRIO_DEFAULT, timeout, probing=True).result()
+
+    # worker thread
+    def _run(self):
+        while True:
+            if not self.connected:
+                self._reconnect()
+            try:
+                timeout = None if self.connected else max(0.0, self._t_retry - time.monotonic())
+                _, _, cmds, fut, t_queued, deadline, probing = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if fut is None:
+                break
+            if not fut.set_running_or_notify_cancel():
+                continue
+            self._execute(cmds, fut, t_queued, deadline, probing)
+        # release everything that was queued behind the sentinel
+        while not self._queue.empty():
+            _, _, cmds, fut = self._queue.get_nowait()[:4]
+            if fut is not None and fut.set_running_or_notify_cancel():
+                fut.set_result([NACK]*len(cmds))
+
+    def _execute(self, cmds, fut, t_queued, deadline, probing):
+        self.wait_time = time.monotonic() - t_queued
+        if deadline is not None:
+            self.serial.timeout = deadline
+        results = []
+        try:
+            for i, cmd in enumerate(cmds):
+                if i > 0:
+                    self._run_stops()
+                if not self.connected:
+                    results.append(NACK)
+                    continue
+                if probing:
+                    results.append(self._write_read_once(cmd, quiet=True))
+                else:
+                    results.append(self._write_read(cmd))
+        except PORT_ERRORS as ex:
+            self._lost_connection(ex)
+        except Exception as ex:
+            fut.set_exception(ex)
+            return
+        finally:
+            if deadline is not None:
+                self.serial.timeout = self.timeout
+        fut.set_result(results + [NACK]*(len(cmds) - len(results)))
+
+    def _run_stops(self):
+        # queued stops overtake the rest of a running batch, stop frames are
+        # independent of the commands around them
+        with self._queue.mutex:
+            heap = self._queue.queue
+            stops = []
+            while heap and heap[0][0] == PRIO_STOP:
+                stops.append(heapq.heappop(heap))
+        if not stops:
+            return
+        timeout = self.serial.timeout
+        self.serial.timeout = self.timeout
+        try:
+            for _, _, cmds, fut, t_queued, deadline, probing in stops:
+                if fut.set_running_or_notify_cancel():
+                    self._execute(cmds, fut, t_queued, deadline, probing)
+        finally:
+            self.serial.timeout = timeout
+
+    def _set_connected(self, connected):
+        self.connected = connected
+        # answers from before an outage are stale
+        self.status_cache.clear()
+        for callback in list(self.state_callbacks):
+            callback(connected)
+
+    def _lost_connection(self, ex):
+        self.warn_stream("connection on {:s} lost: {:s}".format(str(self.serial.port), str(ex)))
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        if self._t_down is None:
+            self._t_down = time.monotonic()
+        self._backoff = self.min_backoff
+        self._t_retry = time.monotonic() + self._backoff
+        self._set_connected(False)
+
+    def _reconnect(self):
+        if time.monotonic() < self._t_retry:
+            return
+        try:
+            self.serial.open()
+        except PORT_ERRORS + (ValueError,) as ex:
+            self.debug_stream("reconnect failed: {:s}".format(str(ex)))
+            self._backoff = min(2*self._backoff, self.max_backoff)
+            self._t_retry = time.monotonic() + self._backoff
+            return
+        # the modules must answer again before the bus is used
+        try:
+            for address in sorted(self.addresses):
+                if "MCC" not in self._write_read(address + "IVR"):
+                    self.warn_stream("module {:s} does not answer after reconnect".format(
+                        address))
+        except PORT_ERRORS as ex:
+            self._lost_connection(ex)
+            return
+        if self._t_down is not None:
+            self._downtime += time.monotonic() - self._t_down
+            self._t_down = None
+        self.reconnect_count += 1
+        self.warn_stream("reconnected to {:s}".format(str(self.serial.port)))
+        self._set_connected(True)
+
+    def _write_read(self, cmd):
+        # repeats the command as often as the retry policy of its class allows
+        cls = command_class(cmd)
+        retries = self.retries.get(cls, 0)
+        for attempt in range(retries + 1):
+            answer = self._write_read_once(cmd)
+            if answer != NACK:
+                return answer
+            if attempt < retries:
+                self.statistics.record_retry(stat_class(cmd))
+                self.debug_stream("retry {:d} of {:s}".format(attempt + 1, cmd))
+        if retries:
+            self.statistics.record_retry(stat_class(cmd), exhausted=True)
+            self.warn_stream("{:s} failed after {:d} retries".format(cmd, retries))
+        return NACK
+
+    def _write_read_once(self, cmd, quiet=False):
+        frame = STX + cmd + ETX
+        self.debug_stream("write command: {:s}".format(frame))
+        t0 = time.monotonic()
+        # drop the remains of replies that arrived after their deadline
+        self.serial.reset_input_buffer()
+        self.serial.write(frame.encode("utf-8"))
+        self.serial.flush()
+        res, complete = self._read_frame(quiet)
+        self.debug_stream("read response: {:s}".format(res))
+        acknowledged = complete and ACK in res
+        self.statistics.record(stat_class(cmd), time.monotonic() - t0,
+                               nack=not acknowledged, timeout=not complete)
+        if acknowledged:
+            return res.lstrip(STX).lstrip(ACK).rstrip(ETX)
+        else:
+            # no acknowledgment in response
+            return NACK
+
+    def _read_frame(self, quiet=False):
+        # returns as soon as the ETX of the reply arrived or the timeout
+        # deadline has passed (then the frame is incomplete), quiet logs a
+        # missing reply only for debugging
+        t0 = time.monotonic()
+        res = self.serial.read_until(ETX.encode("utf-8"))
+        self.response_time = time.monotonic() - t0
+        complete = res.endswith(ETX.encode("utf-8"))
+        if not complete:
+            log_stream = self.debug_stream if quiet else self.warn_stream
+            log_stream("no complete reply within {:f} s".format(self.serial.timeout))
+        return res.decode("utf-8"), complete
+
+
+class StatusCache():
+    """Recent "SE" answers keyed by module address.
+
+    Both axes of a module share one status string, so they can share the
+    answer as long as it is younger than max_age.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = {}
+
+    def get(self, address, max_age=None):
+        # a caller can ask for a fresher answer than max_age
+        if max_age is None or max_age > self.max_age:
+            max_age = self.max_age
+        with self._lock:
+            entry = self._entries.get(address)
+        if entry is not None and time.monotonic() - entry[0] <= max_age:
+            return entry[1]
+        return None
+
+    def generation(self, address):
+        with self._lock:
+            return self._generation.get(address, 0)
+
+    def put(self, address, answer, generation):
+        # an answer requested before the last invalidation is already stale
+        with self._lock:
+            if self._generation.get(address, 0) == generation:
+                self._entries[address] = (time.monotonic(), answer)
+
+    def invalidate(self, address):
+        with self._lock:
+            self._generation[address] = self._generation.get(address, 0) + 1
+            self._entries.pop(address, None)
+
+    def clear(self):
+        with self._lock:
+            for address in list(self._entries):
+                self._generation[address] = self._generation.get(address, 0) + 1
+            self._entries.clear()
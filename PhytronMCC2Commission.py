@@ -0,0 +1,173 @@
+#!/usr/bin/python3 -u
+# coding: utf8
+# PhytronMCC2Commission
+# commissioning of a MCC2 crate: find the modules on a bus and register the
+# controller and axis devices of a manifest in the Tango database
+#
+#     ./PhytronMCC2Commission.py discover sxr/PhytronMCC2/ctrl01
+#     ./PhytronMCC2Commission.py register crate.yaml --dry-run
+#
+# a manifest lists the devices of one or more servers, as YAML
+#
+#     server: PhytronMCC2/raspi14
+#     controllers:
+#       - name: sxr/PhytronMCC2/ctrl01
+#         Port: /dev/ttyMCC
+#         axes:
+#           - {name: sxr/PhytronMCC2/slit_top, Address: 0, Axis: 0, Alias: slit_top}
+#           - {name: sxr/PhytronMCC2/slit_bottom, Address: 0, Axis: 1, Alias: slit_bottom}
+#
+# or as CSV with one device per row, all columns after name are properties
+#
+#     server,class,name,CtrlDevice,Address,Axis,Alias,Port
+#     PhytronMCC2/raspi14,PhytronMCC2Ctrl,sxr/PhytronMCC2/ctrl01,,,,,/dev/ttyMCC
+#     PhytronMCC2/raspi14,PhytronMCC2Axis,sxr/PhytronMCC2/slit_top,sxr/PhytronMCC2/ctrl01,0,0,slit_top,
+import argparse
+import csv
+import sys
+
+CTRL_CLASS = "PhytronMCC2Ctrl"
+AXIS_CLASS = "PhytronMCC2Axis"
+AXIS_PROPERTIES = ("CtrlDevice", "Address", "Axis", "Alias")
+
+
+def discover(ctrl_device, timeout):
+    # [(address, firmware), ...] of the modules that answer on the bus
+    from tango import DeviceProxy
+    ctrl = DeviceProxy(ctrl_device)
+    found = ctrl.discover(timeout)
+    return [(address, firmware) for address, firmware in enumerate(found) if firmware]
+
+
+def read_yaml(filename):
+    try:
+        import yaml
+    except ImportError:
+        raise SystemExit("reading YAML manifests needs PyYAML, use a CSV manifest instead")
+    with open(filename) as f:
+        manifest = yaml.safe_load(f)
+    entries = []
+    for server in manifest if isinstance(manifest, list) else [manifest]:
+        for ctrl in server.get("controllers", []):
+            ctrl = dict(ctrl)
+            axes = ctrl.pop("axes", [])
+            ctrl_name = ctrl.pop("name")
+            entries.append({"server": server["server"],
+                            "class": ctrl.pop("class", CTRL_CLASS),
+                            "name": ctrl_name,
+                            "properties": ctrl})
+            for axis in axes:
+                axis = dict(axis)
+                axis.setdefault("CtrlDevice", ctrl_name)
+                entries.append({"server": server["server"],
+                                "class": axis.pop("class", AXIS_CLASS),
+                                "name": axis.pop("name"),
+                                "properties": axis})
+    return entries
+
+
+def read_csv(filename):
+    entries = []
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            entries.append({"server": row.pop("server"),
+                            "class": row.pop("class"),
+                            "name": row.pop("name"),
+                            "properties": {key: value for key, value in row.items()
+                                           if value not in (None, "")}})
+    return entries
+
+
+def read_manifest(filename):
+    if filename.endswith((".yaml", ".yml")):
+        return read_yaml(filename)
+    return read_csv(filename)
+
+
+def check_manifest(entries):
+    # list of problems, empty if the manifest can be registered
+    problems = []
+    names = set()
+    positions = {}
+    for entry in entries:
+        name = entry["name"].lower()
+        if name in names:
+            problems.append("{:s}: defined twice".format(entry["name"]))
+        names.add(name)
+        if name.count("/") != 2:
+            problems.append("{:s}: not a domain/family/member name".format(entry["name"]))
+        if entry["class"].endswith("Axis"):
+            props = entry["properties"]
+            missing = [prop for prop in AXIS_PROPERTIES if prop not in props]
+            if missing:
+                problems.append("{:s}: missing {:s}".format(entry["name"], ", ".join(missing)))
+                continue
+            if not 0 <= int(props["Address"]) <= 15 or int(props["Axis"]) not in (0, 1):
+                problems.append("{:s}: Address 0..15 and Axis 0/1 expected".format(
+                    entry["name"]))
+            position = (str(props["CtrlDevice"]).lower(), int(props["Address"]),
+                        int(props["Axis"]))
+            if position in positions:
+                problems.append("{:s}: same axis as {:s}".format(
+                    entry["name"], positions[position]))
+            positions[position] = entry["name"]
+    return problems
+
+
+def register(entries):
+    from tango import Database, DbDevInfo
+    db = Database()
+    # the devices of each server are added in one call
+    servers = {}
+    for entry in entries:
+        info = DbDevInfo()
+        info.name = entry["name"]
+        info._class = entry["class"]
+        info.server = entry["server"]
+        servers.setdefault(entry["server"], []).append(info)
+    for server, infos in servers.items():
+        db.add_server(server, infos)
+        print("server {:s}: {:d} devices".format(server, len(infos)))
+    for entry in entries:
+        properties = {key: [str(value)] for key, value in entry["properties"].items()}
+        if properties:
+            db.put_device_property(entry["name"], properties)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="commissioning of PhytronMCC2 devices")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    parser_discover = subparsers.add_parser("discover", help="list the modules on a bus")
+    parser_discover.add_argument("ctrl", help="device name of a running PhytronMCC2Ctrl")
+    parser_discover.add_argument("--timeout", type=float, default=0.02,
+                                 help="reply deadline in s per address")
+    parser_register = subparsers.add_parser("register",
+                                            help="register the devices of a manifest")
+    parser_register.add_argument("manifest", help="YAML (.yaml, .yml) or CSV manifest")
+    parser_register.add_argument("--dry-run", action="store_true",
+                                 help="only check and print the manifest")
+    args = parser.parse_args()
+
+    if args.action == "discover":
+        modules = discover(args.ctrl, args.timeout)
+        for address, firmware in modules:
+            print("{:2d} (0x{:X}): {:s}".format(address, address, firmware))
+        print("{:d} modules found".format(len(modules)))
+        return 0
+
+    entries = read_manifest(args.manifest)
+    problems = check_manifest(entries)
+    for problem in problems:
+        print(problem)
+    if problems:
+        return 1
+    for entry in entries:
+        print("{:s} {:s} {:s} {:s}".format(entry["server"], entry["class"], entry["name"],
+                                           str(entry["properties"])))
+    if not args.dry_run:
+        register(entries)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,5 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
 from tango import DeviceProxy
 
 
@@ -47,12 +49,9 @@ class PhytronMCC2Configurator():
 
     def read_current_config(self):
         self.current_config = {}
-        import io
-        raw_conf = self.proxy.dump_config()
-        buf = io.StringIO(raw_conf)
-        for line in buf:
-            [param, value] = line.strip().split(':')
-            self.current_config[int(param.replace('P', ''))] = float(value.strip())
+        raw_conf = json.loads(self.proxy.dump_config_json())
+        for param, value in raw_conf.items():
+            self.current_config[int(param.replace('P', ''))] = value
 
     def compare_configs(self, read_current_config=True):
         if read_current_config:
@@ -68,13 +67,29 @@ class PhytronMCC2Configurator():
                                         'same' if curr_value == val_list[0] else 'changed',
                                         val_list[1],))
 
+    def diff_config(self, reference=None, read_current_config=True):
+        # {param: [current, reference]} of the differing parameters
+        if read_current_config:
+            self.read_current_config()
+        if reference is None:
+            reference = default_profile()
+        return {param: [self.current_config.get(param), value]
+                for param, value in normalize_profile(reference).items()
+                if self.current_config.get(param) != value}
+
     def reset_to_default(self, save_to_eeprom=False):
+        # only the parameters that differ are written, counters are kept
         print('Setting the following default parameters:')
         print('=========================================')
-        for param, val_list in self.default_config.items():
-            cmd = 'P{:02d}S{:f}'.format(param, val_list[0])
-            print('P{:02d}: {:10.2f}\t{:s}'.format(param, val_list[0], val_list[1],))
-            _ = self.proxy.send_cmd(cmd)
+        result = json.loads(self.proxy.load_config(json.dumps(
+            {'P{:02d}'.format(param): value for param, value in default_profile().items()})))
+        for param in sorted(result['written']):
+            nr = int(param.lstrip('P'))
+            print('P{:02d}: {:10.2f}\t{:s}'.format(
+                nr, self.default_config[nr][0], self.default_config[nr][1]))
+        for param in result['failed']:
+            print('{:s}: failed'.format(param))
+        print('{:d} parameters already set'.format(len(result['unchanged'])))
         print('=========================================')
         if save_to_eeprom:
             self.proxy.write_to_eeprom()
@@ -82,3 +97,111 @@ class PhytronMCC2Configurator():
         else:
             print('Config NOT permanently saved to EEPROM')
             print('Use save_to_eeprom=True as parameter')
+
+
+# counters are positions, no configuration
+COUNTER_PARAMS = (19, 20, 21, 22)
+
+
+def default_profile():
+    return {param: val_list[0] for param, val_list in
+            PhytronMCC2Configurator.default_config.items() if param not in COUNTER_PARAMS}
+
+
+def normalize_profile(profile):
+    # {"P01": value} or {1: value} as in dump_config_json -> {1: value}
+    return {int(str(param).lstrip('Pp')): value for param, value in profile.items()
+            if value is not None and int(str(param).lstrip('Pp')) not in COUNTER_PARAMS}
+
+
+class PhytronMCC2Fleet():
+    """Configuration of many axes against one reference profile.
+
+    The axes are grouped by their controller, the groups run in parallel
+    since each controller has its own bus, the axes of one controller are
+    handled one after the other. All methods return {device: result}.
+    """
+
+    def __init__(self, devices, reference=None, max_workers=None):
+        self.proxies = {device: DeviceProxy(device) for device in devices}
+        self.reference = normalize_profile(default_profile() if reference is None else reference)
+        self.max_workers = max_workers
+        self.modules = {}
+        self.groups = {}
+        for device, proxy in self.proxies.items():
+            props = proxy.get_property(['CtrlDevice', 'Address'])
+            ctrl = (list(props['CtrlDevice']) or [''])[0].lower()
+            address = int((list(props['Address']) or [0])[0])
+            self.modules[device] = (ctrl, address)
+            self.groups.setdefault(ctrl, []).append(device)
+
+    @classmethod
+    def from_json(cls, devices, filename, max_workers=None):
+        # reference profile from a file written with dump_config_json
+        with open(filename) as f:
+            return cls(devices, json.load(f), max_workers)
+
+    def _run(self, func, devices=None):
+        # func(device) for all devices, one thread per controller
+        devices = set(self.proxies if devices is None else devices)
+        results = {}
+
+        def run_group(group):
+            for device in group:
+                if device not in devices:
+                    continue
+                try:
+                    results[device] = func(device)
+                except Exception as ex:
+                    results[device] = {'error': str(ex)}
+
+        workers = self.max_workers or max(1, len(self.groups))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run_group, self.groups.values()))
+        return results
+
+    def read_configs(self):
+        # {device: {param: value}}
+        return self._run(lambda device: normalize_profile(
+            json.loads(self.proxies[device].dump_config_json())))
+
+    def diff(self, configs=None):
+        # {device: {param: [current, reference]}} of the differing parameters
+        if configs is None:
+            configs = self.read_configs()
+        diffs = {}
+        for device, config in configs.items():
+            if 'error' in config:
+                diffs[device] = config
+                continue
+            diffs[device] = {param: [config.get(param), value]
+                             for param, value in self.reference.items()
+                             if config.get(param) != value}
+        return diffs
+
+    def apply(self, save_to_eeprom=False):
+        # writes the differing parameters, load_config of the axis reads the
+        # current values and writes only the changed ones in one transaction
+        profile = json.dumps({'P{:02d}'.format(param): value
+                              for param, value in self.reference.items()})
+        results = self._run(lambda device: json.loads(self.proxies[device].load_config(profile)))
+        if save_to_eeprom:
+            saved = self.save_to_eeprom([device for device, result in results.items()
+                                         if result.get('written')])
+            for device, result in saved.items():
+                results[device].update(result)
+        return results
+
+    def save_to_eeprom(self, devices=None):
+        # the EEPROM save (SA) stores both axes of a module, so once per module
+        devices = list(self.proxies if devices is None else devices)
+        savers = {}
+        for device in devices:
+            savers.setdefault(self.modules[device], device)
+
+        def save(device):
+            self.proxies[device].write_to_eeprom()
+            return {'saved': True}
+
+        saved = self._run(save, savers.values())
+        return {device: saved[savers[self.modules[device]]] for device in devices}
@@ -1,11 +1,17 @@
 #!/usr/bin/python3 -u
 # coding: utf8
 # PhytronMCC2Ctrl
-from tango import DevState, AttrWriteType, DispLevel
+from tango import AutoTangoAllowThreads, DevState, AttrWriteType, DispLevel, Except
 from tango.server import Device, attribute, command, device_property
+import asyncio
+import json
+import threading
 import time
-import sys
 import serial
+from PhytronMCC2Bus import MCC2Bus, NACK, AXIS_NAMES, STAT_CLASSES, LATENCY_BINS
+from PhytronMCC2Bus import split_command, command_class, invalidates_status
+from PhytronMCC2Bus import format_address, decode_status, register_local, unregister_local
+from PhytronMCC2Bus import RETRY_DEFAULTS, parse_retry_policy, acquire_bus, release_bus
 
 
 class PhytronMCC2Ctrl(Device):
@@ -20,6 +26,49 @@ class PhytronMCC2Ctrl(Device):
         default_value=115200,
     )
 
+    Timeout = device_property(
+        dtype="float",
+        default_value=0.1,
+        doc="deadline in s for a complete reply frame",
+    )
+
+    StatusMaxAge = device_property(
+        dtype="float",
+        default_value=0.1,
+        doc="max. age in s of a cached module status (SE), 0 disables the cache",
+    )
+
+    Polling = device_property(
+        dtype="bool",
+        default_value=False,
+        doc="poll status and position of all registered axes in the background",
+    )
+
+    PollPeriodMoving = device_property(
+        dtype="float",
+        default_value=0.05,
+        doc="poll period in s for modules with a moving axis",
+    )
+
+    PollPeriodIdle = device_property(
+        dtype="float",
+        default_value=1.0,
+        doc="poll period in s for modules with idle axes",
+    )
+
+    ReconnectMaxBackoff = device_property(
+        dtype="float",
+        default_value=5.0,
+        doc="max. interval in s between attempts to reopen a lost port",
+    )
+
+    RetryPolicy = device_property(
+        dtype=("str",),
+        default_value=[],
+        doc="repetitions after a NACK or timeout, e.g. status=2, motion=0; "
+            "classes: status, param_read, param_write, motion, stop, other",
+    )
+
     # device attributes
     port = attribute(
         dtype="str",
@@ -35,19 +84,174 @@ class PhytronMCC2Ctrl(Device):
         display_level=DispLevel.OPERATOR,
     )
 
+    response_time = attribute(
+        dtype="float",
+        format="%6.2f",
+        label="response time",
+        unit="ms",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="time waited for the last complete reply frame",
+    )
+
+    queue_depth = attribute(
+        dtype="int",
+        label="queue depth",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="number of transactions waiting for the bus",
+    )
+
+    queue_wait_time = attribute(
+        dtype="float",
+        format="%6.2f",
+        label="queue wait time",
+        unit="ms",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="time the last transaction waited for the bus",
+    )
+
+    statistics_classes = attribute(
+        dtype=("str",),
+        max_dim_x=len(STAT_CLASSES),
+        label="statistics classes",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="command classes, index of the per class statistics",
+    )
+
+    command_counts = attribute(
+        dtype=("int",),
+        max_dim_x=len(STAT_CLASSES),
+        label="command counts",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="number of commands per class",
+    )
+
+    nack_counts = attribute(
+        dtype=("int",),
+        max_dim_x=len(STAT_CLASSES),
+        label="NACK counts",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="number of not acknowledged commands per class",
+    )
+
+    timeout_counts = attribute(
+        dtype=("int",),
+        max_dim_x=len(STAT_CLASSES),
+        label="timeout counts",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="number of commands without complete reply per class",
+    )
+
+    retry_counts = attribute(
+        dtype=("int",),
+        max_dim_x=len(STAT_CLASSES),
+        label="retry counts",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="number of repeated commands per class",
+    )
+
+    retry_exhausted_counts = attribute(
+        dtype=("int",),
+        max_dim_x=len(STAT_CLASSES),
+        label="retries exhausted",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="number of commands per class that failed after all retries",
+    )
+
+    mean_latency = attribute(
+        dtype=("float",),
+        max_dim_x=len(STAT_CLASSES),
+        label="mean latency",
+        unit="ms",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="mean transaction time per class",
+    )
+
+    latency_bins = attribute(
+        dtype=("float",),
+        max_dim_x=len(LATENCY_BINS),
+        label="latency bins",
+        unit="ms",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="upper bounds of the latency histogram bins, the last bin is open",
+    )
+
+    latency_histogram = attribute(
+        dtype=(("int",),),
+        max_dim_x=len(LATENCY_BINS) + 1,
+        max_dim_y=len(STAT_CLASSES),
+        label="latency histogram",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="transaction time histogram, one row per class",
+    )
+
+    coalesced_count = attribute(
+        dtype="int",
+        label="coalesced requests",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="read requests answered by an identical transaction already in flight",
+    )
+
+    bus_utilisation = attribute(
+        dtype="float",
+        format="%5.1f",
+        label="bus utilisation",
+        unit="%",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="share of the wall time the port was busy since the last reset",
+    )
+
+    connected = attribute(
+        dtype="bool",
+        label="connected",
+        access=AttrWriteType.READ,
+        doc="serial port open and usable",
+    )
+
+    reconnect_count = attribute(
+        dtype="int",
+        label="reconnects",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="number of successful reconnects after a lost port",
+    )
+
+    downtime = attribute(
+        dtype="float",
+        format="%8.1f",
+        label="downtime",
+        unit="s",
+        access=AttrWriteType.READ,
+        display_level=DispLevel.EXPERT,
+        doc="total time without connection since the start",
+    )
+
+    homing_report = attribute(
+        dtype="str",
+        label="homing report",
+        access=AttrWriteType.READ,
+        doc="JSON of the last homing plan: state, start and duration per axis",
+    )
+
     # connection settings
     PARITY = serial.PARITY_NONE  # serial.PARITY_NONE, serial.PARITY_ODD, serial.PARITY_EVEN
     FLOWCONTROL = "none"  # "none", "software", "hardware", "sw/hw"
-    TIMEOUT = 0
     BYTESIZE = 8
     STOPBITS = 1
 
-    # definition some constants
-    __STX = chr(2)         # Start of text
-    __ACK = chr(6)         # Command ok
-    __NACK = chr(0x15)     # command failed
-    __ETX = chr(3)         # end of text
-
     def init_device(self):
         self.info_stream("init_device()")
         self.get_device_properties(self.get_device_class())
@@ -60,7 +264,7 @@ class PhytronMCC2Ctrl(Device):
         self.serial.parity = self.PARITY
         self.serial.bytesize = self.BYTESIZE
         self.serial.stopbits = self.STOPBITS
-        self.serial.timeout = self.TIMEOUT
+        self.serial.timeout = self.Timeout
 
         if self.FLOWCONTROL == "none":
             self.serial.xonxoff = 0
@@ -77,11 +281,46 @@ class PhytronMCC2Ctrl(Device):
 
         self.info_stream("port: {:s}".format(self.Port))
         self.info_stream("baudrate = {:d}".format(self.Baudrate))
+        self.info_stream("timeout = {:f} s".format(self.Timeout))
+        try:
+            retries = parse_retry_policy(self.RetryPolicy)
+        except ValueError as ex:
+            self.warn_stream("invalid RetryPolicy, using defaults: {:s}".format(str(ex)))
+            retries = RETRY_DEFAULTS
+        self.info_stream("retries: {:s}".format(
+            ", ".join("{:s}={:d}".format(cls, n) for cls, n in retries.items())))
+
+        # all bus access is serialized by the transaction queue of the port,
+        # the bus is created on open or shared with other devices on the port
+        self._retries = retries
+        self.bus = None
+        self._bus_open = False
+        # the bus logs through the first of its devices that is still open
+        self._streams = (self.debug_stream, self.warn_stream)
+
+        # registered axes {address: set(axis)}, their sign and in-process listeners
+        self._axes = {}
+        # the axes register from their threads while the poller iterates
+        self._axes_lock = threading.Lock()
+        self._inverted = {}
+        self._limits = {}
+        self._listeners = {}
+        self._group = []
+        self._homing = None
+        self._homing_abort = threading.Event()
+        self._homing_report = {}
+        self._poll_due = {}
+        self._poll_wake = threading.Event()
+        self._poller = None
+        self._polling = False
+        register_local(self.get_name(), self)
 
         # open serial port
         self.open()
 
     def delete_device(self):
+        unregister_local(self.get_name())
+        self._abort_homing()
         self.close()
 
     # attribute read/write methods
@@ -91,18 +330,79 @@ class PhytronMCC2Ctrl(Device):
     def read_baudrate(self):
         return int(self.Baudrate)
 
+    def read_response_time(self):
+        return self._open_bus().response_time*1000
+
+    def read_queue_depth(self):
+        return self._open_bus().queue_depth
+
+    def read_queue_wait_time(self):
+        return self._open_bus().wait_time*1000
+
+    def read_statistics_classes(self):
+        return list(STAT_CLASSES)
+
+    def read_command_counts(self):
+        return [self._open_bus().statistics.counts[cls] for cls in STAT_CLASSES]
+
+    def read_nack_counts(self):
+        return [self._open_bus().statistics.nacks[cls] for cls in STAT_CLASSES]
+
+    def read_timeout_counts(self):
+        return [self._open_bus().statistics.timeouts[cls] for cls in STAT_CLASSES]
+
+    def read_retry_counts(self):
+        return [self._open_bus().statistics.retries[cls] for cls in STAT_CLASSES]
+
+    def read_retry_exhausted_counts(self):
+        return [self._open_bus().statistics.retries_exhausted[cls] for cls in STAT_CLASSES]
+
+    def read_mean_latency(self):
+        return [self._open_bus().statistics.mean_latency(cls)*1000 for cls in STAT_CLASSES]
+
+    def read_latency_bins(self):
+        return [float(bound) for bound in LATENCY_BINS]
+
+    def read_latency_histogram(self):
+        return [self._open_bus().statistics.histogram[cls] for cls in STAT_CLASSES]
+
+    def read_coalesced_count(self):
+        return self._open_bus().statistics.coalesced
+
+    def read_bus_utilisation(self):
+        return self._open_bus().statistics.utilisation()*100
+
+    def read_connected(self):
+        return self.bus is not None and self.bus.connected
+
+    def read_reconnect_count(self):
+        return self._open_bus().reconnect_count
+
+    def read_downtime(self):
+        return self._open_bus().downtime
+
+    def read_homing_report(self):
+        return json.dumps(self._homing_report)
+
     # commands
     @command
     def open(self):
         self.info_stream("open()")
 
-        try:
-            self.serial.open()
-            self.set_state(DevState.ON)
-            self.info_stream("connected to {:s}".format(self.Port))
-        except Exception:
-            self.error_stream("failed to open {:s}".format(self.Port))
-            sys.exit(255)
+        # the bus opens the port and keeps reopening it if it fails
+        if not self._bus_open:
+            try:
+                self.bus = acquire_bus(self.Port, self._create_bus, self._connection_changed,
+                                       self._streams, self._bus_settings())
+            except ValueError as ex:
+                # another ctrl. device of this server has the port
+                self.error_stream(str(ex))
+                self.set_state(DevState.FAULT)
+                self.set_status(str(ex))
+                return
+            self._bus_open = True
+        if self.Polling:
+            self.start_poller()
 
     def is_open_allowed(self):
         if self.get_state() in [DevState.ON, DevState.FAULT]:
@@ -112,7 +412,10 @@ class PhytronMCC2Ctrl(Device):
     @command
     def close(self):
         try:
-            self.serial.close()
+            self.stop_poller()
+            if self._bus_open:
+                self._bus_open = False
+                release_bus(self.Port, self._connection_changed, self._streams)
             self.set_state(DevState.OFF)
             self.info_stream("closed connection on {:s}".format(self.Port))
         except Exception:
@@ -125,24 +428,438 @@ class PhytronMCC2Ctrl(Device):
 
     @command(dtype_in=str, dtype_out=str)
     def write_read(self, cmd):
-        cmd = self.__STX + cmd + self.__ETX
-        self.debug_stream("write command: {:s}".format(cmd))
-        self.serial.write(cmd.encode("utf-8"))
-        self.serial.flush()
-        time.sleep(0.02)  # 20ms wait time
-        res = self.serial.readline().decode("utf-8")
-        self.debug_stream("read response: {:s}".format(res))
-        if self.__ACK in res:
-            return res.lstrip(self.__STX).lstrip(self.__ACK).rstrip(self.__ETX)
-        else:
-            # no acknowledgment in response
-            return self.__NACK
+        return self.transact(cmd)
 
     def is_write_allowed(self):
         if self.get_state() in [DevState.FAULT, DevState.OFF]:
             return False
         return True
 
+    @command(dtype_in=[str], dtype_out=[str], doc_in="list of commands",
+             doc_out="list of responses, NACK for each command not acknowledged")
+    def write_read_many(self, cmds):
+        return self.transact_many(cmds)
+
+    def is_write_read_many_allowed(self):
+        if self.get_state() in [DevState.FAULT, DevState.OFF]:
+            return False
+        return True
+
+    @command
+    def reset_statistics(self):
+        self._open_bus().statistics.reset()
+        self.info_stream("statistics reset")
+
+    @command(dtype_in=[float],
+             doc_in="[address, axis], [address, axis, inverted] or [address, axis, inverted, "
+                    "sw_limit_minus, sw_limit_plus] with the soft limits as P24, P23 of the "
+                    "module (0 is off)")
+    def register_axis(self, address_axis):
+        address = format_address(address_axis[0])
+        axis = int(address_axis[1])
+        if len(address_axis) > 2:
+            self._inverted[(address, axis)] = bool(address_axis[2])
+        if len(address_axis) > 4:
+            self._limits[(address, axis)] = (float(address_axis[3]), float(address_axis[4]))
+        with self._axes_lock:
+            if axis in self._axes.get(address, set()):
+                return
+            self._axes.setdefault(address, set()).add(axis)
+            self._poll_due[address] = 0.0
+        self._poll_wake.set()
+        if self.bus is not None:
+            self.bus.addresses.add(address)
+        self.info_stream("registered axis {:d} of module {:s}".format(axis, address))
+
+    @command(dtype_in=float, dtype_out=[str],
+             doc_in="reply deadline in s per module, 0 for 0.02 s",
+             doc_out="firmware version per address 0..15, empty if no module answers")
+    def discover(self, timeout):
+        answers = self._open_bus().probe(range(16), timeout or 0.02)
+        found = ["" if answer == NACK else answer for answer in answers]
+        for address, firmware in enumerate(found):
+            if firmware:
+                self.info_stream("module {:X}: {:s}".format(address, firmware))
+        self.info_stream("{:d} modules found".format(len([f for f in found if f])))
+        return found
+
+    def is_discover_allowed(self):
+        if self.get_state() in [DevState.FAULT, DevState.OFF]:
+            return False
+        return True
+
+    @command(dtype_in=[float], dtype_out=[bool],
+             doc_in="[address, axis, target, address, axis, target, ...], "
+                    "targets in the units of the axis as the position attribute, checked "
+                    "against the soft limits of registered axes",
+             doc_out="acknowledged start per entry")
+    def move_group(self, entries):
+        if len(entries) % 3 != 0 or len(entries) == 0:
+            Except.throw_exception("PhytronMCC2_InvalidInput",
+                                   "expected [address, axis, target] triples", "move_group")
+        cmds = []
+        group = []
+        for address, axis, position in zip(entries[0::3], entries[1::3], entries[2::3]):
+            address = format_address(address)
+            axis = int(axis)
+            # the sign of inverted axes is applied as in their position attribute,
+            # the unit conversion (P02, P03) is done by the modules
+            target = position
+            if self._inverted.get((address, axis), False):
+                target = -1*position
+            # nothing is started if one target is outside the soft limits
+            limit_minus, limit_plus = self._limits.get((address, axis), (0.0, 0.0))
+            if (limit_minus and target < limit_minus) or (limit_plus and target > limit_plus):
+                Except.throw_exception("PhytronMCC2_OutOfRange",
+                                       "target {:f} of axis {:d} of module {:s} outside the "
+                                       "soft limits".format(position, axis, address),
+                                       "move_group")
+            cmds.append("{:s}{:s}A{:.10f}".format(address, AXIS_NAMES[axis], target))
+            group.append((address, axis))
+        # all start frames back-to-back in one bus transaction
+        answers = self.transact_many(cmds)
+        self._group = group
+        self.info_stream("group move of {:d} axes started".format(len(group)))
+        return [answer != NACK for answer in answers]
+
+    def is_move_group_allowed(self):
+        if self.get_state() in [DevState.FAULT, DevState.OFF]:
+            return False
+        return True
+
+    @command(dtype_in=float, dtype_out=bool, doc_in="timeout in s",
+             doc_out="True if all axes of the last group move are idle, False on timeout")
+    def wait_group_idle(self, timeout):
+        # the axes keep using this device while it waits
+        with AutoTangoAllowThreads(self):
+            return self.wait_idle(self._group, timeout)
+
+    @command(dtype_in=str,
+             doc_in="JSON {\"axes\": [{\"name\": \"slit\", \"address\": 0, \"axis\": 0, "
+                    "\"direction\": \"-\", \"after\": [names]}, ...], "
+                    "\"max_concurrent\": 0, \"timeout\": 300}")
+    def start_homing(self, plan):
+        if self._homing is not None and self._homing.is_alive():
+            Except.throw_exception("PhytronMCC2_HomingRunning", "a homing plan is running",
+                                   "start_homing")
+        entries, max_concurrent, timeout = self._parse_homing_plan(plan)
+        self._homing_abort.clear()
+        self._homing_report = {"running": True, "elapsed": 0.0, "axes": {
+            entry["name"]: {"address": entry["address"], "axis": entry["axis"],
+                            "direction": entry["direction"], "state": "pending",
+                            "start": None, "duration": None} for entry in entries}}
+        self._homing = threading.Thread(target=self._run_homing,
+                                        args=(entries, max_concurrent, timeout),
+                                        name="MCC2Homing", daemon=True)
+        self._homing.start()
+
+    def is_start_homing_allowed(self):
+        if self.get_state() in [DevState.FAULT, DevState.OFF]:
+            return False
+        return True
+
+    @command
+    def abort_homing(self):
+        self._abort_homing()
+
+    @command(dtype_in=float, dtype_out=bool, doc_in="timeout in s",
+             doc_out="True if the homing plan has ended, False on timeout")
+    def wait_homing(self, timeout):
+        homing = self._homing
+        if homing is not None:
+            with AutoTangoAllowThreads(self):
+                homing.join(timeout)
+            return not homing.is_alive()
+        return True
+
+    # internal methods
+    def _create_bus(self):
+        return MCC2Bus(self.serial, self.Timeout, max_backoff=self.ReconnectMaxBackoff,
+                       retries=self._retries, status_max_age=self.StatusMaxAge)
+
+    def _open_bus(self):
+        # the bus for attributes and commands, DevFailed if the port is not open
+        if self.bus is None:
+            Except.throw_exception("PhytronMCC2_NotOpen",
+                                   "{:s} is not open: {:s}".format(self.Port, self.get_status()),
+                                   "PhytronMCC2Ctrl")
+        return self.bus
+
+    def _bus_settings(self):
+        # all ctrl. devices sharing a port must agree on these
+        return {"Baudrate": int(self.Baudrate), "Timeout": self.Timeout,
+                "RetryPolicy": self._retries, "ReconnectMaxBackoff": self.ReconnectMaxBackoff,
+                "StatusMaxAge": self.StatusMaxAge}
+
+    def _connection_changed(self, connected):
+        # called by the bus worker
+        if connected:
+            self.set_state(DevState.ON)
+            self.set_status("connected to {:s}".format(self.Port))
+            self.info_stream("connected to {:s}".format(self.Port))
+        else:
+            self.set_state(DevState.ALARM)
+            self.set_status("connection lost, reconnecting to {:s}".format(self.Port))
+
+    def transact(self, cmd, max_age=None):
+        return self.transact_many([cmd], max_age)[0]
+
+    def transact_many(self, cmds, max_age=None):
+        if self.bus is None:
+            # the port could not be opened, see the status
+            return [NACK]*len(cmds)
+        answers, pending, generations = self._prepare(cmds, max_age)
+        results = self.bus.transact_many([cmds[i] for i in pending])
+        return self._complete(cmds, answers, pending, generations, results)
+
+    async def transact_many_async(self, cmds, max_age=None):
+        # awaits the bus transaction without blocking the event loop
+        if self.bus is None:
+            return [NACK]*len(cmds)
+        answers, pending, generations = self._prepare(cmds, max_age)
+        results = await asyncio.wrap_future(self.bus.submit([cmds[i] for i in pending]))
+        return self._complete(cmds, answers, pending, generations, results)
+
+    def _prepare(self, cmds, max_age=None):
+        # status requests are served from the cache where possible, all other
+        # commands are sent in one bus transaction
+        answers = [None]*len(cmds)
+        pending = []
+        generations = {}
+        for i, cmd in enumerate(cmds):
+            address, _ = split_command(cmd)
+            if command_class(cmd) == "status":
+                answers[i] = self.bus.status_cache.get(address, max_age)
+                generations[address] = self.bus.status_cache.generation(address)
+            if answers[i] is None:
+                pending.append(i)
+        return answers, pending, generations
+
+    def _complete(self, cmds, answers, pending, generations, results):
+        for i, answer in zip(pending, results):
+            answers[i] = answer
+            cmd = cmds[i]
+            address, _ = split_command(cmd)
+            if command_class(cmd) == "status":
+                if answer != NACK:
+                    self.bus.status_cache.put(address, answer, generations[address])
+            elif invalidates_status(cmd):
+                self.bus.status_cache.invalidate(address)
+                if address in self._poll_due:
+                    # poll the module right away to catch the start of the move
+                    self._poll_due[address] = 0.0
+                    self._poll_wake.set()
+        return answers
+
+    def wait_idle(self, axes, timeout, interval=None):
+        # one shared status request per module and poll cycle
+        if interval is None:
+            interval = self.PollPeriodMoving
+        addresses = sorted(set(address for address, _ in axes))
+        t_end = time.monotonic() + timeout
+        while True:
+            answers = self.transact_many([a + "SE" for a in addresses], max_age=interval)
+            moving = self._moving(axes, addresses, answers)
+            if not moving:
+                return True
+            if time.monotonic() >= t_end:
+                self.warn_stream("{:d} axes still moving after {:f} s".format(
+                    len(moving), timeout))
+                return False
+            time.sleep(interval)
+
+    def _moving(self, axes, addresses, answers):
+        # the axes that move or whose module did not answer the status request
+        answers = dict(zip(addresses, answers))
+        return [(address, axis) for address, axis in axes
+                if answers[address] == NACK or decode_status(answers[address], axis)[0]]
+
+    def _parse_homing_plan(self, plan):
+        try:
+            plan = json.loads(plan)
+            entries = []
+            for entry in plan["axes"]:
+                address = format_address(entry["address"])
+                axis = int(entry["axis"])
+                if axis not in (0, 1) or entry.get("direction", "-") not in ("+", "-"):
+                    raise ValueError("axis 0/1 and direction +/- expected")
+                entries.append({"name": str(entry.get("name", "{:s}.{:d}".format(address, axis))),
+                                "address": address, "axis": axis,
+                                "direction": entry.get("direction", "-"),
+                                "after": [str(name) for name in entry.get("after", [])]})
+            max_concurrent = int(plan.get("max_concurrent", 0))
+            timeout = float(plan.get("timeout", 300.0))
+        except (ValueError, KeyError, TypeError) as ex:
+            Except.throw_exception("PhytronMCC2_InvalidInput",
+                                   "invalid homing plan: {:s}".format(str(ex)), "start_homing")
+        names = [entry["name"] for entry in entries]
+        unknown = set(dep for entry in entries for dep in entry["after"]) - set(names)
+        if len(set(names)) != len(names) or unknown:
+            Except.throw_exception("PhytronMCC2_InvalidInput",
+                                   "duplicate names or unknown dependencies {:s}".format(
+                                       ", ".join(sorted(unknown))), "start_homing")
+        return entries, max_concurrent, timeout
+
+    def _run_homing(self, entries, max_concurrent, timeout):
+        # starts every axis whose dependencies are homed, all axes in motion
+        # share one status request per module and poll cycle
+        report = self._homing_report["axes"]
+        pending = list(entries)
+        running = {}
+        t0 = time.monotonic()
+        try:
+            while pending or running:
+                # axes whose dependencies failed are skipped
+                for entry in list(pending):
+                    if any(report[dep]["state"] not in ("pending", "running", "homed")
+                           for dep in entry["after"]):
+                        report[entry["name"]]["state"] = "skipped"
+                        pending.remove(entry)
+                ready = [entry for entry in pending
+                         if all(report[dep]["state"] == "homed" for dep in entry["after"])]
+                if max_concurrent > 0:
+                    ready = ready[:max(0, max_concurrent - len(running))]
+                if ready:
+                    cmds = []
+                    for entry in ready:
+                        direction = entry["direction"]
+                        if self._inverted.get((entry["address"], entry["axis"]), False):
+                            direction = "+" if direction == "-" else "-"
+                        cmds.append("{:s}{:s}0{:s}".format(entry["address"],
+                                                           AXIS_NAMES[entry["axis"]], direction))
+                    # the start frames of all ready axes back-to-back
+                    answers = self.transact_many(cmds)
+                    t_start = time.monotonic()
+                    for entry, answer in zip(ready, answers):
+                        pending.remove(entry)
+                        report[entry["name"]]["start"] = t_start - t0
+                        if answer == NACK:
+                            report[entry["name"]]["state"] = "failed"
+                        else:
+                            report[entry["name"]]["state"] = "running"
+                            running[entry["name"]] = (entry, t_start)
+                elif not running:
+                    # dependency cycle
+                    for entry in pending:
+                        report[entry["name"]]["state"] = "skipped"
+                    break
+                if self._homing_abort.wait(self.PollPeriodMoving):
+                    self._stop_homing(running, report, "aborted")
+                    for entry in pending:
+                        report[entry["name"]]["state"] = "aborted"
+                    break
+                addresses = sorted(set(entry["address"] for entry, _ in running.values()))
+                status = dict(zip(addresses, self.transact_many([a + "SE" for a in addresses],
+                                                                max_age=self.PollPeriodMoving)))
+                now = time.monotonic()
+                for name, (entry, t_start) in list(running.items()):
+                    answer = status[entry["address"]]
+                    if answer != NACK and not decode_status(answer, entry["axis"])[0]:
+                        report[name]["state"] = "homed"
+                        report[name]["duration"] = now - t_start
+                        del running[name]
+                    elif now - t_start > timeout:
+                        self._stop_homing({name: running.pop(name)}, report, "timeout")
+                self._homing_report["elapsed"] = now - t0
+        except Exception as ex:
+            # the axes must not keep moving unattended
+            self.error_stream("homing plan failed: {}".format(ex))
+            self._homing_report["error"] = str(ex)
+            try:
+                self._stop_homing(running, report, "failed")
+            except Exception:
+                for name in running:
+                    report[name]["state"] = "failed"
+            for entry in pending:
+                report[entry["name"]]["state"] = "skipped"
+        finally:
+            self._homing_report["elapsed"] = time.monotonic() - t0
+            self._homing_report["running"] = False
+        durations = [axis["duration"] for axis in report.values() if axis["duration"]]
+        self.info_stream("homing plan ended after {:.1f} s, sum of the axes {:.1f} s".format(
+            self._homing_report["elapsed"], sum(durations)))
+
+    def _stop_homing(self, running, report, state):
+        now = time.monotonic()
+        self.transact_many(["{:s}{:s}S".format(entry["address"], AXIS_NAMES[entry["axis"]])
+                            for entry, _ in running.values()])
+        for name, (_, t_start) in running.items():
+            report[name]["state"] = state
+            report[name]["duration"] = now - t_start
+
+    def _abort_homing(self):
+        homing = self._homing
+        if homing is not None:
+            self._homing_abort.set()
+            homing.join()
+
+    def add_listener(self, address, axis, callback):
+        # callback(status, position) is called by the poller with the raw answers
+        self._listeners[(format_address(address), int(axis))] = callback
+        self.register_axis([address, axis])
+
+    def remove_listener(self, address, axis):
+        self._listeners.pop((format_address(address), int(axis)), None)
+
+    def start_poller(self):
+        if self._poller is not None:
+            return
+        self._polling = True
+        self._poller = threading.Thread(target=self._poll_loop, name="MCC2Poller", daemon=True)
+        self._poller.start()
+        self.info_stream("background polling started")
+
+    def stop_poller(self):
+        if self._poller is None:
+            return
+        self._polling = False
+        self._poll_wake.set()
+        self._poller.join()
+        self._poller = None
+        self.info_stream("background polling stopped")
+
+    def _poll_loop(self):
+        while self._polling:
+            self._poll_wake.clear()
+            try:
+                with self._axes_lock:
+                    addresses = sorted(self._axes)
+                for address in addresses:
+                    if not self._polling:
+                        break
+                    if self._poll_due.get(address, 0.0) <= time.monotonic():
+                        try:
+                            self._poll_module(address)
+                        except Exception as ex:
+                            self.warn_stream("polling module {:s} failed: {:s}".format(
+                                address, str(ex)))
+                            self._poll_due[address] = time.monotonic() + self.PollPeriodIdle
+                with self._axes_lock:
+                    dues = list(self._poll_due.values())
+                due = min(dues, default=time.monotonic() + self.PollPeriodIdle)
+            except Exception as ex:
+                # the poller must survive anything, it feeds the events of all axes
+                self.warn_stream("polling failed: {:s}".format(str(ex)))
+                due = time.monotonic() + self.PollPeriodIdle
+            self._poll_wake.wait(max(0.0, due - time.monotonic()))
+
+    def _poll_module(self, address):
+        status = self.transact(address + "SE")
+        moving = False
+        with self._axes_lock:
+            axes = sorted(self._axes[address])
+        for axis in axes:
+            position = self.transact(address + AXIS_NAMES[axis] + "P20R")
+            if status != NACK:
+                moving = moving or decode_status(status, axis)[0]
+            callback = self._listeners.get((address, axis))
+            if callback is not None:
+                callback(status, position)
+        if moving:
+            self._poll_due[address] = time.monotonic() + self.PollPeriodMoving
+        else:
+            self._poll_due[address] = time.monotonic() + self.PollPeriodIdle
+
 
 if __name__ == "__main__":
     PhytronMCC2Ctrl.run_server()
@@ -0,0 +1,344 @@
+#!/usr/bin/python3 -u
+# coding: utf8
+# PhytronMCC2Sim
+# simulator of MCC2 modules on a RS485 bus for tests and benchmarks without hardware
+#
+# run it standalone to get a pseudo terminal that a PhytronMCC2Ctrl can use as Port:
+#     ./PhytronMCC2Sim.py --addresses 0 1 2 --latency 0.002 --link /tmp/ttyMCC
+import argparse
+import os
+import re
+import termios
+import threading
+import time
+import tty
+from serial import SerialException
+from PhytronMCC2Bus import STX, ACK, NACK, ETX, AXIS_NAMES, LIM_MINUS, LIM_PLUS
+
+FIRMWARE = "MCC2 MINI-LOG V3.3 (simulated)"
+
+# power-on parameter values (see the MCC2 manual)
+DEFAULT_PARAMETERS = {
+    1: 1, 2: 1, 3: 1.0, 4: 400, 7: 100000, 8: 4000, 9: 4000, 10: 400,
+    11: 0, 12: 0, 13: 20, 14: 4000, 15: 4000, 16: 20, 17: 0, 19: 0,
+    20: 0, 21: 0, 22: 0, 23: 0, 24: 0, 25: 0, 27: 0, 34: 0, 35: 10,
+    36: 0, 38: 0, 39: 1.0, 40: 2, 41: 6, 42: 10, 43: 20, 45: 4, 46: 1,
+    47: 1,
+}
+
+
+class SimAxis():
+    """One stepper axis with linear motion between two limit switches.
+
+    Positions are in units of the axis (P02/P03), the limit switches sit at
+    fixed physical positions, P20 counts relative to the mechanical zero.
+    """
+
+    def __init__(self, limit_minus=-100.0, limit_plus=100.0):
+        self.parameters = {nr: DEFAULT_PARAMETERS.get(nr, 0) for nr in range(1, 50)}
+        self.limit_minus = limit_minus
+        self.limit_plus = limit_plus
+        self.physical = 0.0
+        self.zero = 0.0
+        self.target = None
+        self.homing = False
+        self.velocity = 0.0
+        self.t_start = 0.0
+        self.start = 0.0
+        self.lock = threading.Lock()
+
+    # motion
+    def _update(self):
+        if self.target is None:
+            return
+        dt = time.monotonic() - self.t_start
+        distance = self.target - self.start
+        travelled = min(abs(distance), self.velocity*dt)
+        self.physical = self.start + (travelled if distance >= 0 else -travelled)
+        if (distance < 0 and self.physical <= self.limit_minus) or \
+                (distance > 0 and self.physical >= self.limit_plus):
+            # limit switch reached
+            self.physical = min(max(self.physical, self.limit_minus), self.limit_plus)
+            self._stop()
+        elif travelled >= abs(distance):
+            self._stop()
+
+    def _stop(self):
+        if self.homing:
+            # the limit switch defines the mechanical zero
+            self.zero = self.physical
+        self.target = None
+        self.homing = False
+
+    def _move_to(self, physical, frequency, homing=False):
+        self.start = self.physical
+        self.target = physical
+        self.homing = homing
+        # P03 is the travel per step
+        self.velocity = abs(frequency*float(self.parameters[3])) or 1.0
+        self.t_start = time.monotonic()
+        self._update()
+
+    def moving(self):
+        with self.lock:
+            self._update()
+            return self.target is not None
+
+    def limits(self):
+        with self.lock:
+            self._update()
+            bits = 0
+            if self.physical <= self.limit_minus:
+                bits |= LIM_MINUS
+            if self.physical >= self.limit_plus:
+                bits |= LIM_PLUS
+            return bits
+
+    # axis commands, return the reply data or None for NACK
+    def command(self, cmd):
+        with self.lock:
+            self._update()
+            match = re.fullmatch(r"P(\d\d)R", cmd)
+            if match:
+                return self._read_parameter(int(match.group(1)))
+            match = re.fullmatch(r"P(\d\d)S(.+)", cmd)
+            if match:
+                return self._write_parameter(int(match.group(1)), match.group(2))
+            if cmd.startswith("A"):
+                try:
+                    target = float(cmd[1:])
+                except ValueError:
+                    return None
+                self._move_to(target + self.zero, self.parameters[14])
+                return ""
+            if cmd in ("L+", "L-"):
+                limit = self.limit_plus if cmd == "L+" else self.limit_minus
+                self._move_to(limit, self.parameters[14])
+                return ""
+            if cmd in ("0+", "0-"):
+                limit = self.limit_plus if cmd == "0+" else self.limit_minus
+                self._move_to(limit, self.parameters[8], homing=True)
+                return ""
+            if cmd in ("S", "SN"):
+                if self.target is not None:
+                    self.target = None
+                    self.homing = False
+                return ""
+            return None
+
+    def _read_parameter(self, nr):
+        if nr not in self.parameters:
+            return None
+        if nr in (20, 21):
+            value = self.physical - self.zero
+        elif nr == 22:
+            # the encoder follows the motor with a small offset
+            value = round((self.physical - self.zero)/float(self.parameters[39] or 1) + 0.001, 3)
+        else:
+            value = self.parameters[nr]
+        if isinstance(value, float):
+            return "{:.4f}".format(value)
+        return "{:d}".format(value)
+
+    def _write_parameter(self, nr, value):
+        if nr not in self.parameters:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        if nr == 20:
+            self.zero = self.physical - value
+        elif isinstance(DEFAULT_PARAMETERS.get(nr, 0), int) and value.is_integer():
+            self.parameters[nr] = int(value)
+        else:
+            self.parameters[nr] = value
+        return ""
+
+
+class SimModule():
+
+    def __init__(self, address, **axis_kwargs):
+        self.address = address
+        self.axes = [SimAxis(**axis_kwargs), SimAxis(**axis_kwargs)]
+
+    def status(self):
+        # four digits per axis: reserved, idle bit, limit switch bits, reserved
+        res = ""
+        for axis in self.axes:
+            res += "0{:d}{:d}0".format(0 if axis.moving() else 1, axis.limits())
+        return res
+
+    def command(self, cmd):
+        if cmd == "IVR":
+            return FIRMWARE
+        if cmd == "SE":
+            return self.status()
+        if cmd == "SA":
+            return ""
+        if cmd[:1] in AXIS_NAMES:
+            return self.axes[AXIS_NAMES.index(cmd[:1])].command(cmd[1:])
+        return None
+
+
+class MCC2Simulator():
+    """Protocol engine for up to 16 MCC2 modules on one bus."""
+
+    def __init__(self, addresses=range(16), latency=0.0, **axis_kwargs):
+        self.modules = {"{:X}".format(addr): SimModule(addr, **axis_kwargs) for addr in addresses}
+        self.latency = latency
+
+    def handle(self, frame):
+        # frame is STX + address + command + ETX, returns the reply frame or
+        # None if no module answers
+        if not (frame.startswith(STX) and frame.endswith(ETX)):
+            return None
+        cmd = frame[1:-1]
+        module = self.modules.get(cmd[:1])
+        if module is None:
+            return None
+        data = module.command(cmd[1:])
+        if data is None:
+            return STX + NACK + ETX
+        return STX + ACK + data + ETX
+
+
+class SimulatedSerial():
+    """In-process stand-in for serial.Serial connected to a MCC2Simulator."""
+
+    def __init__(self, simulator, port="sim://", baudrate=115200, timeout=None):
+        self.simulator = simulator
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = False
+        self._buffer = b""
+        self._reply = None
+        self._t_reply = 0.0
+        # set by unplug() to fail like a USB adapter that was pulled
+        self.unplugged = False
+
+    def unplug(self):
+        self.unplugged = True
+
+    def plug(self):
+        self.unplugged = False
+
+    def open(self):
+        if self.unplugged:
+            raise SerialException("could not open port {}: no such device".format(self.port))
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        if self.unplugged:
+            # pyserial passes the error of tcflush() on, which is no OSError
+            raise termios.error(5, "Input/output error")
+        self._buffer = b""
+        self._reply = None
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        self._buffer += data
+        end = self._buffer.find(ETX.encode("utf-8"))
+        if end >= 0:
+            frame, self._buffer = self._buffer[:end + 1], self._buffer[end + 1:]
+            reply = self.simulator.handle(frame.decode("utf-8"))
+            self._reply = None if reply is None else reply.encode("utf-8")
+            self._t_reply = time.monotonic() + self.simulator.latency
+        return len(data)
+
+    def read_until(self, expected=b"\n", size=None):
+        if self._reply is None:
+            if self.timeout:
+                time.sleep(self.timeout)
+            return b""
+        delay = self._t_reply - time.monotonic()
+        if self.timeout is not None and delay > self.timeout:
+            time.sleep(self.timeout)
+            return b""
+        if delay > 0:
+            time.sleep(delay)
+        reply, self._reply = self._reply, None
+        return reply
+
+
+class PtySimulator():
+    """Serves a MCC2Simulator on the slave side of a pseudo terminal."""
+
+    def __init__(self, simulator, link=None):
+        self.simulator = simulator
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.link = link
+        if link is not None:
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+            self.port = link
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name="MCC2Sim", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def _serve(self):
+        buffer = b""
+        while self._running:
+            try:
+                buffer += os.read(self.master, 1024)
+            except OSError:
+                break
+            while ETX.encode("utf-8") in buffer:
+                end = buffer.index(ETX.encode("utf-8"))
+                frame, buffer = buffer[:end + 1], buffer[end + 1:]
+                reply = self.simulator.handle(frame.decode("utf-8", "replace"))
+                if reply is None:
+                    continue
+                if self.simulator.latency:
+                    time.sleep(self.simulator.latency)
+                os.write(self.master, reply.encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simulated MCC2 bus on a pseudo terminal")
+    parser.add_argument("--addresses", type=int, nargs="+", default=list(range(16)),
+                        help="module addresses 0..15 present on the bus")
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="reply latency of the modules in s")
+    parser.add_argument("--limits", type=float, nargs=2, default=[-100.0, 100.0],
+                        help="positions of the limit switches")
+    parser.add_argument("--link", default=None,
+                        help="create a symlink to the pseudo terminal, e.g. /tmp/ttyMCC")
+    args = parser.parse_args()
+
+    simulator = MCC2Simulator(args.addresses, args.latency,
+                              limit_minus=args.limits[0], limit_plus=args.limits[1])
+    server = PtySimulator(simulator, args.link)
+    server.start()
+    print("simulated MCC2 bus on {:s}".format(server.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
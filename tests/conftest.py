@@ -0,0 +1,46 @@
+# the modules live in the root of the repository
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PhytronMCC2Bus import MCC2Bus  # noqa: E402
+from PhytronMCC2Sim import MCC2Simulator, SimulatedSerial  # noqa: E402
+
+
+class RecordingSimulator(MCC2Simulator):
+    """MCC2Simulator that keeps the commands in the order they reached the bus."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = []
+        self.fail = {}
+
+    def handle(self, frame):
+        cmd = frame[1:-1]
+        self.commands.append(cmd)
+        # NACK the next n frames of a command
+        if self.fail.get(cmd, 0) > 0:
+            self.fail[cmd] -= 1
+            return super().handle(frame[:2] + "?" + frame[-1:])
+        return super().handle(frame)
+
+
+@pytest.fixture
+def simulator():
+    return RecordingSimulator([0, 1], latency=0.0, limit_minus=-50.0, limit_plus=50.0)
+
+
+@pytest.fixture
+def port(simulator):
+    return SimulatedSerial(simulator, timeout=0.05)
+
+
+@pytest.fixture
+def bus(port):
+    bus = MCC2Bus(port, 0.05, min_backoff=0.01, max_backoff=0.05)
+    bus.addresses.add("0")
+    bus.start()
+    yield bus
+    bus.stop()
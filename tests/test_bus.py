@@ -0,0 +1,247 @@
+import threading
+import time
+import pytest
+from PhytronMCC2Bus import MCC2Bus, NACK, RETRY_DEFAULTS, StatusCache
+from PhytronMCC2Bus import acquire_bus, release_bus, command_class, parse_retry_policy
+from PhytronMCC2Bus import decode_status
+from PhytronMCC2Sim import SimulatedSerial
+
+
+def hold_bus(bus, simulator, duration=0.1):
+    # a transaction that keeps the worker busy while the test queues more
+    simulator.latency = duration
+    busy = bus.submit(["0XP14R"])
+    time.sleep(duration/2)
+    simulator.latency = 0.0
+    return busy
+
+
+def test_transaction(bus):
+    assert "MCC" in bus.transact("0IVR")
+    assert bus.transact("0XP14R") == "4000"
+    assert bus.transact_many(["0XP14S2000", "0XP14R"]) == ["", "2000"]
+
+
+def test_missing_module_answers_nack(bus):
+    assert bus.transact("5IVR") == NACK
+    assert bus.statistics.timeouts["other"] == 1
+
+
+def test_priority_order(bus, simulator):
+    busy = hold_bus(bus, simulator)
+    poll = bus.submit(["0SE"])
+    param = bus.submit(["0XP15S4000"])
+    motion = bus.submit(["0XA1"])
+    stop = bus.submit(["0YS"])
+    for fut in (busy, poll, param, motion, stop):
+        fut.result()
+    assert simulator.commands[-4:] == ["0YS", "0XA1", "0XP15S4000", "0SE"]
+
+
+def test_stop_runs_between_commands_of_a_batch(bus, simulator):
+    simulator.latency = 0.005
+    batch = bus.submit(["0XP{:02d}R".format(nr) for nr in range(1, 41)])
+    time.sleep(0.02)
+    t0 = time.monotonic()
+    assert bus.transact("0XS") == ""
+    assert time.monotonic() - t0 < 0.05
+    assert len(batch.result()) == 40
+    assert simulator.commands.index("0XS") < len(simulator.commands) - 1
+
+
+def test_coalescing(bus, simulator):
+    busy = hold_bus(bus, simulator)
+    first = bus.submit(["0SE"])
+    second = bus.submit(["0SE"])
+    assert first is second
+    busy.result()
+    assert first.result() == ["01000100"]
+    assert simulator.commands.count("0SE") == 1
+    assert bus.statistics.coalesced == 1
+
+
+def test_writes_are_not_coalesced(bus, simulator):
+    busy = hold_bus(bus, simulator)
+    first = bus.submit(["0XP14S100"])
+    second = bus.submit(["0XP14S100"])
+    assert first is not second
+    busy.result()
+    first.result()
+    second.result()
+    assert simulator.commands.count("0XP14S100") == 2
+
+
+def test_retry_counting(bus, simulator):
+    simulator.fail["0XP14R"] = 1
+    assert bus.transact("0XP14R") == "4000"
+    assert bus.statistics.retries["param_read"] == 1
+    assert bus.statistics.retries_exhausted["param_read"] == 0
+    simulator.fail["0XP14R"] = RETRY_DEFAULTS["param_read"] + 1
+    assert bus.transact("0XP14R") == NACK
+    assert bus.statistics.retries["param_read"] == 1 + RETRY_DEFAULTS["param_read"]
+    assert bus.statistics.retries_exhausted["param_read"] == 1
+
+
+def test_relative_moves_are_not_retried(port, simulator):
+    bus = MCC2Bus(port, 0.05, retries=parse_retry_policy(["motion=0"]))
+    bus.start()
+    try:
+        simulator.fail["0XA5"] = 1
+        assert bus.transact("0XA5") == NACK
+        assert simulator.commands.count("0XA5") == 1
+    finally:
+        bus.stop()
+
+
+def test_probe_without_retries(port, simulator):
+    warnings = []
+    bus = MCC2Bus(port, 0.05, warn_stream=warnings.append,
+                  retries=parse_retry_policy(["other=3"]))
+    bus.start()
+    try:
+        answers = bus.probe(range(4), 0.005)
+    finally:
+        bus.stop()
+    assert ["MCC" in answer for answer in answers] == [True, True, False, False]
+    assert simulator.commands.count("2IVR") == 1
+    assert warnings == []
+
+
+def test_reconnect(bus, port):
+    states = []
+    bus.state_callbacks.append(states.append)
+    port.unplug()
+    assert bus.transact("0SE") == NACK
+    assert not bus.connected
+    # fails fast while the port is gone
+    t0 = time.monotonic()
+    assert bus.transact("0SE") == NACK
+    assert time.monotonic() - t0 < 0.01
+    time.sleep(0.1)
+    port.plug()
+    t_end = time.monotonic() + 1.0
+    while not bus.connected and time.monotonic() < t_end:
+        time.sleep(0.01)
+    assert bus.connected
+    assert bus.reconnect_count == 1
+    assert bus.downtime > 0.1
+    assert states == [False, True]
+    assert bus.transact("0SE") == "01000100"
+
+
+def test_reconnect_backoff(bus, port):
+    port.unplug()
+    bus.transact("0SE")
+    opens = []
+    open_port = port.open
+
+    def counting_open():
+        opens.append(time.monotonic())
+        open_port()
+    port.open = counting_open
+    time.sleep(0.3)
+    # the intervals double up to max_backoff
+    intervals = [b - a for a, b in zip(opens, opens[1:])]
+    assert 3 <= len(opens) <= 12
+    assert max(intervals) <= bus.max_backoff + 0.03
+    assert intervals[-1] >= intervals[0]
+
+
+def test_start_without_port(simulator):
+    port = SimulatedSerial(simulator, timeout=0.05)
+    port.unplug()
+    bus = MCC2Bus(port, 0.05, min_backoff=0.01)
+    bus.start()
+    try:
+        assert not bus.connected
+        port.plug()
+        time.sleep(0.1)
+        assert bus.transact("0SE") == "01000100"
+    finally:
+        bus.stop()
+
+
+def test_status_cache_generations():
+    cache = StatusCache(1.0)
+    generation = cache.generation("0")
+    cache.put("0", "01000100", generation)
+    assert cache.get("0") == "01000100"
+    assert cache.get("0", max_age=0.0) is None
+    # an answer requested before an invalidation must not be cached
+    generation = cache.generation("0")
+    cache.invalidate("0")
+    cache.put("0", "00000100", generation)
+    assert cache.get("0") is None
+    cache.put("0", "00000100", cache.generation("0"))
+    assert cache.get("0") == "00000100"
+    cache.clear()
+    assert cache.get("0") is None
+
+
+def test_bus_clears_status_cache_on_reconnect(bus, port):
+    bus.status_cache.put("0", "01000100", bus.status_cache.generation("0"))
+    port.unplug()
+    bus.transact("0SE")
+    assert bus.status_cache.get("0") is None
+
+
+def test_shared_bus(simulator):
+    factory = lambda: MCC2Bus(SimulatedSerial(simulator, timeout=0.05), 0.05)  # noqa: E731
+    logs = []
+    first = (logs.append, logs.append)
+    second = (lambda msg: logs.append("second " + msg), lambda msg: logs.append("second " + msg))
+    bus = acquire_bus("sim://test", factory, streams=first, settings={"Timeout": 0.05})
+    try:
+        assert acquire_bus("sim://test", factory, streams=second,
+                           settings={"Timeout": 0.05}) is bus
+        with pytest.raises(ValueError):
+            acquire_bus("sim://test", factory, settings={"Timeout": 0.1})
+        release_bus("sim://test", streams=first)
+        assert bus.connected
+        bus.warn_stream("message")
+        assert logs == ["second message"]
+    finally:
+        release_bus("sim://test", streams=second)
+    assert not bus.connected
+
+
+def test_parse_retry_policy():
+    policy = parse_retry_policy(["status=5", " motion = 0"])
+    assert policy["status"] == 5
+    assert policy["motion"] == 0
+    assert policy["stop"] == RETRY_DEFAULTS["stop"]
+    with pytest.raises(ValueError):
+        parse_retry_policy(["unknown=1"])
+
+
+@pytest.mark.parametrize("cmd, cls", [
+    ("0XS", "stop"), ("0YSN", "stop"), ("0XP14R", "param_read"), ("0XP14S10", "param_write"),
+    ("0XA5", "motion"), ("0YL+", "motion"), ("0X0-", "motion"), ("0SE", "status"),
+    ("0IVR", "other"),
+])
+def test_command_class(cmd, cls):
+    assert command_class(cmd) == cls
+
+
+def test_decode_status():
+    assert decode_status("01000100", 0) == (False, False, False)
+    assert decode_status("01000000", 1) == (True, False, False)
+    assert decode_status("01000120", 1) == (False, False, True)
+    assert decode_status("01100100", 0) == (False, True, False)
+    assert decode_status("01100100", 0, inverted=True) == (False, False, True)
+
+
+def test_concurrent_clients(bus):
+    errors = []
+
+    def client():
+        for _ in range(50):
+            if bus.transact("0XP14R") != "4000":
+                errors.append("wrong answer")
+
+    threads = [threading.Thread(target=client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
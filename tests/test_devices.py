@@ -0,0 +1,120 @@
+import json
+import pytest
+from PhytronMCC2Sim import PtySimulator
+
+tango = pytest.importorskip("tango")
+from tango import DevFailed, DeviceProxy  # noqa: E402
+from tango.test_context import DeviceTestContext, MultiDeviceTestContext  # noqa: E402
+from PhytronMCC2Axis import PhytronMCC2Axis  # noqa: E402
+from PhytronMCC2Ctrl import PhytronMCC2Ctrl  # noqa: E402
+
+
+@pytest.fixture
+def pty(simulator):
+    server = PtySimulator(simulator)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def ctrl(pty):
+    # the device server runs in its own process, the simulator in the test
+    properties = {"Port": pty.port, "Timeout": 0.05, "StatusMaxAge": 0.0,
+                  "PollPeriodMoving": 0.01}
+    with DeviceTestContext(PhytronMCC2Ctrl, properties=properties, process=True) as proxy:
+        yield proxy
+
+
+@pytest.fixture
+def axis(pty):
+    devices_info = [
+        {"class": PhytronMCC2Ctrl,
+         "devices": [{"name": "test/mcc2/ctrl",
+                      "properties": {"Port": pty.port, "Timeout": 0.05}}]},
+        {"class": PhytronMCC2Axis,
+         "devices": [{"name": "test/mcc2/axis0",
+                      "properties": {"CtrlDevice": "test/mcc2/ctrl", "Address": 0,
+                                     "Axis": 0, "Alias": "axis0"}}]},
+    ]
+    with MultiDeviceTestContext(devices_info, process=True) as context:
+        yield DeviceProxy(context.get_device_access("test/mcc2/axis0"))
+
+
+def run_homing(ctrl, axes, timeout=10.0):
+    ctrl.start_homing(json.dumps({"axes": axes, "max_concurrent": 0, "timeout": timeout}))
+    assert ctrl.wait_homing(5.0)
+    return json.loads(ctrl.homing_report)
+
+
+def test_homing_dependencies(ctrl):
+    report = run_homing(ctrl, [
+        {"name": "b", "address": 0, "axis": 1, "direction": "+", "after": ["a"]},
+        {"name": "a", "address": 0, "axis": 0, "direction": "-"},
+    ])
+    a, b = report["axes"]["a"], report["axes"]["b"]
+    assert not report["running"]
+    assert a["state"] == b["state"] == "homed"
+    assert b["start"] >= a["start"] + a["duration"]
+
+
+def test_homing_skips_dependents_of_failed_axes(ctrl):
+    # module 3 is not on the bus
+    report = run_homing(ctrl, [
+        {"name": "missing", "address": 3, "axis": 0},
+        {"name": "after_missing", "address": 0, "axis": 0, "after": ["missing"]},
+        {"name": "independent", "address": 0, "axis": 1},
+    ])
+    states = {name: axis["state"] for name, axis in report["axes"].items()}
+    assert states == {"missing": "failed", "after_missing": "skipped", "independent": "homed"}
+
+
+def test_homing_timeout(ctrl, simulator):
+    # a far limit switch, the axis needs 0.25 s
+    simulator.modules["0"].axes[0].limit_minus = -1000.0
+    report = run_homing(ctrl, [
+        {"name": "slow", "address": 0, "axis": 0},
+        {"name": "after_slow", "address": 0, "axis": 1, "after": ["slow"]},
+    ], timeout=0.02)
+    assert report["axes"]["slow"]["state"] == "timeout"
+    assert report["axes"]["after_slow"]["state"] == "skipped"
+    assert not simulator.modules["0"].axes[0].moving()
+
+
+def test_homing_cycle(ctrl):
+    report = run_homing(ctrl, [
+        {"name": "a", "address": 0, "axis": 0, "after": ["b"]},
+        {"name": "b", "address": 0, "axis": 1, "after": ["a"]},
+    ])
+    assert [axis["state"] for axis in report["axes"].values()] == ["skipped", "skipped"]
+
+
+def test_homing_plan_with_unknown_dependency(ctrl):
+    with pytest.raises(DevFailed):
+        ctrl.start_homing(json.dumps({"axes": [{"name": "a", "address": 0, "axis": 0,
+                                                "after": ["nothing"]}]}))
+
+
+def test_move_group_soft_limits(ctrl, simulator):
+    ctrl.register_axis([0, 0, 0, -10.0, 10.0])
+    ctrl.register_axis([0, 1, 1])
+    with pytest.raises(DevFailed):
+        ctrl.move_group([0, 0, 20.0, 0, 1, 5.0])
+    # nothing is started if one target is rejected
+    assert simulator.commands.count("0XA20.0000000000") == 0
+    assert "0YA-5.0000000000" not in simulator.commands
+    assert list(ctrl.move_group([0, 0, 5.0, 0, 1, 5.0])) == [True, True]
+    assert "0YA-5.0000000000" in simulator.commands
+    assert ctrl.wait_group_idle(5.0)
+
+
+def test_load_config(axis, simulator):
+    result = json.loads(axis.load_config(json.dumps({"P14": 4000, "P15": 2000, "P21": 7})))
+    # the counter P21 is never written
+    assert result == {"written": {"P15": 2000}, "unchanged": ["P14"], "failed": []}
+    assert simulator.modules["0"].axes[0].parameters[15] == 2000
+    simulator.fail["0XP16S30"] = 10
+    result = json.loads(axis.load_config(json.dumps({"P15": 2000, "P16": 30})))
+    assert result == {"written": {}, "unchanged": ["P15"], "failed": ["P16"]}
+    config = json.loads(axis.dump_config_json())
+    assert config["P15"] == 2000